@@ -4,6 +4,7 @@ VERSION = "0.0.6" # Version of pedlar
 SECRET_KEY = "secretmaster3000" # Secret key for sessions
 
 BCRYPT_LOG_ROUNDS = 12 # Number of encryption rounds
+BCRYPT_THREADS = 4 # Maximum number of passwords hashed at the same time in native threads
 
 SQLALCHEMY_DATABASE_URI = "sqlite://" # In memory database by default
 SQLALCHEMY_TRACK_MODIFICATIONS = False # Disable event system
@@ -11,9 +12,30 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False # Disable event system
 BROKER_URL = "tcp://localhost:7100" # Broker tcp endpoint
 BROKER_TIMEOUT = 4000 # Milliseconds to wait for response
 BROKER_LINGER = 2000 # Milliseconds to wait for closing broker socket
+BROKER_BATCH_SIZE = 32 # Maximum number of requests in a single broker message, at most 32
+BROKER_POOL_SIZE = 8 # Maximum number of pooled broker connections
+BROKER_HEALTH_INTERVAL = 30000 # Milliseconds idle before checking a connection
 TICKER_URL = "tcp://localhost:7000" # Ticker tcp endpoint
+TICKER_INTERVAL = 250 # Milliseconds between tick updates sent to browsers
+TICKER_ACK_TIMEOUT = 5000 # Milliseconds before an unacknowledged tick is ignored
+TICKER_SYMBOLS = [] # Symbol names to receive ticks for, all symbols if empty
 
 GOOGLE_ANALYTICS = "" # GA Code UA-###
 LEADERBOARD_SIZE = 10 # Displays top N users
 RECENT_ORDERS_SIZE = 30 # Displays N most recent orders
+ORDER_PAGE_MAX = 500 # Maximum number of orders in a single order history page
 TICK_HIST_SIZE = 40 # Number ticks in tick chart
+
+ORDER_WRITE_BEHIND = False # Queue order writes and commit them in batches
+ORDER_QUEUE_SIZE = 10000 # Maximum queued order writes before flushing immediately
+ORDER_FLUSH_INTERVAL = 500 # Milliseconds between order write flushes
+ORDER_FLUSH_BACKOFF = 30000 # Maximum milliseconds between retries of failed order write flushes
+
+PNL_LEVERAGE = 100 # Account leverage of the broker used to value open orders
+PNL_INTERVAL = 1000 # Milliseconds between unrealized profit updates sent to users
+PNL_SYMBOL = "" # Symbol open orders are valued at, latest tick of any symbol if empty
+
+CHANNEL_URL = "" # ZMQ trading channel bind address ex. tcp://*:7200, disabled if empty
+CHANNEL_WORKERS = 16 # Maximum number of channel messages handled concurrently
+
+METRICS = False # Record latency histograms of trades, broker and database served at /metrics
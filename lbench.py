@@ -0,0 +1,100 @@
+"""Order query benchmark for the pedlarweb database."""
+import argparse
+import datetime
+import random
+import time
+
+import sqlalchemy as sa
+
+# Designed to run locally only
+if __name__ != "__main__":
+  raise RuntimeError("Can only run as stand-alone script.")
+
+# Setup Arguments
+parser = argparse.ArgumentParser(description=__doc__, fromfile_prefix_chars='@')
+parser.add_argument("-d", "--database", default="sqlite:///bench.db", help="Database URL, emptied first.")
+parser.add_argument("-n", "--orders", default=1000000, type=int, help="Number of orders to seed.")
+parser.add_argument("-u", "--users", default=1000, type=int, help="Number of users.")
+parser.add_argument("-r", "--repeat", default=200, type=int, help="Queries timed per measurement.")
+parser.add_argument("-l", "--limit", default=30, type=int, help="Orders per page.")
+ARGS = parser.parse_args()
+
+# Same columns as pedlarweb.models.Order, indexes are added later
+metadata = sa.MetaData()
+orders = sa.Table('order', metadata,
+                  sa.Column('id', sa.Integer, primary_key=True),
+                  sa.Column('user_id', sa.Integer, nullable=False),
+                  sa.Column('agent', sa.String(128)),
+                  sa.Column('type', sa.String(8), nullable=False),
+                  sa.Column('price_open', sa.Float, nullable=False),
+                  sa.Column('volume', sa.Float, nullable=False),
+                  sa.Column('price_close', sa.Float),
+                  sa.Column('profit', sa.Float),
+                  sa.Column('closed', sa.DateTime),
+                  sa.Column('created', sa.DateTime, nullable=False))
+
+def seed(engine):
+  """Fill the order table with random orders, about 1 in 100 left open."""
+  start = datetime.datetime(2019, 1, 1)
+  batch = 50000
+  with engine.begin() as conn:
+    for first in range(0, ARGS.orders, batch):
+      rows = list()
+      for oid in range(first+1, min(first+batch, ARGS.orders)+1):
+        created = start + datetime.timedelta(seconds=oid)
+        is_open = random.random() < 0.01
+        rows.append({'id': oid, 'user_id': random.randrange(ARGS.users), 'agent': "bench",
+                     'type': random.choice(("BUY", "SELL")), 'price_open': 1.3, 'volume': 0.01,
+                     'price_close': None if is_open else 1.31, 'profit': None if is_open else 0.1,
+                     'closed': None if is_open else created + datetime.timedelta(seconds=60),
+                     'created': created})
+      conn.execute(orders.insert(), rows)
+
+def recent(user_id, before=None):
+  """Most recent page of orders as in views.get_orders."""
+  query = sa.select(orders).where(orders.c.user_id == user_id)
+  if before is not None:
+    query = query.where(sa.or_(orders.c.created < before[0],
+                               sa.and_(orders.c.created == before[0], orders.c.id < before[1])))
+  return query.order_by(orders.c.created.desc(), orders.c.id.desc()).limit(ARGS.limit)
+
+def measure(engine, name, make_query):
+  """Time queries of random users and print the mean in milliseconds."""
+  users = [random.randrange(ARGS.users) for _ in range(ARGS.repeat)]
+  with engine.connect() as conn:
+    queries = [make_query(conn, u) for u in users]
+    start = time.perf_counter()
+    for query in queries:
+      conn.execute(query).fetchall()
+    elapsed = time.perf_counter() - start
+  print("{:<24} {:>10.3f} ms".format(name, elapsed/ARGS.repeat*1000))
+
+def deep_key(conn, user_id):
+  """(created, id) key half way through the orders of a user."""
+  count = conn.execute(sa.select(sa.func.count()).where(orders.c.user_id == user_id)).scalar()
+  row = conn.execute(sa.select(orders.c.created, orders.c.id).where(orders.c.user_id == user_id).
+                     order_by(orders.c.created.desc(), orders.c.id.desc()).
+                     offset(count//2).limit(1)).first()
+  return tuple(row) if row else None
+
+def run_all(engine):
+  """Time every order query the web server makes."""
+  measure(engine, "recent orders", lambda conn, u: recent(u))
+  measure(engine, "keyset deep page", lambda conn, u: recent(u, deep_key(conn, u)))
+  measure(engine, "offset deep page",
+          lambda conn, u: recent(u).offset(ARGS.orders//ARGS.users//2))
+  measure(engine, "open orders", lambda conn, u: sa.select(orders).where(
+    orders.c.user_id == u, orders.c.closed.is_(None)))
+
+ENGINE = sa.create_engine(ARGS.database)
+metadata.drop_all(ENGINE)
+metadata.create_all(ENGINE)
+print("Seeding {} orders of {} users...".format(ARGS.orders, ARGS.users))
+seed(ENGINE)
+print("-- without indexes")
+run_all(ENGINE)
+# Same indexes as pedlarweb.models.Order
+sa.Index('ix_order_user_created', orders.c.user_id, orders.c.created).create(ENGINE)
+sa.Index('ix_order_user_closed', orders.c.user_id, orders.c.closed).create(ENGINE)
+print("-- with indexes")
+run_all(ENGINE)
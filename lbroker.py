@@ -1,11 +1,21 @@
 """Local execution broker for Flask Broker."""
 import argparse
-from collections import namedtuple
+from collections import namedtuple, defaultdict
+import os
 import struct
 import logging
-from eventlet import GreenPool
+import time
+import zlib
+from eventlet import GreenPool, sleep, tpool
+from eventlet.event import Event
+from eventlet.queue import LightQueue
 from eventlet.green import zmq
 
+from pedlar import protocol
+from pedlar.protocol import REQUEST, RESPONSE
+from pedlar.execution import LEVERAGE, profit
+from pedlar.metrics import Histogram
+
 # Designed to run locally only
 if __name__ != "__main__":
   raise RuntimeError("Can only run as stand-alone script.")
@@ -16,7 +26,14 @@ parser = argparse.ArgumentParser(description=__doc__, fromfile_prefix_chars='@')
 parser.add_argument("-t", "--ticker", default="tcp://127.0.0.1:7000", help="Ticker URL")
 parser.add_argument("-b", "--broker_host", default="tcp://127.0.0.1:7100", help="Broker serve URL")
 parser.add_argument("-i", "--order_id", default=1, type=int, help="Initial order id")
-parser.add_argument("-l", "--leverage", default=100, type=int, help="Account leverage")
+parser.add_argument("-y", "--symbol", help="Symbol to execute orders on, latest tick of any symbol if not given")
+parser.add_argument("-l", "--leverage", default=LEVERAGE, type=int, help="Account leverage")
+parser.add_argument("-w", "--workers", default=4, type=int, help="Number of request workers")
+parser.add_argument("-j", "--journal", help="Order journal file, orders are kept in memory only if not given")
+parser.add_argument("--journal_interval", default=2, type=float, help="Milliseconds between journal group commits")
+parser.add_argument("--journal_compact", default=64, type=float,
+                    help="Megabytes of journal before compacting into a snapshot")
+parser.add_argument("-s", "--stats", default=10, type=float, help="Seconds between stats logs, 0 to disable")
 ARGS = parser.parse_args()
 
 # Context are thread safe already,
@@ -25,71 +42,319 @@ context = zmq.Context()
 Order = namedtuple('Order', ['id', 'price', 'volume', 'type'])
 
 # Globals
-BID, ASK = 0.0, 0.0
-ORDERS = dict() # Orders indexed using order id
+# Latest bid, ask per symbol id, None for the latest of any symbol
+PRICES = {None: (0.0, 0.0)}
+SYMBOL = protocol.symbol_id(ARGS.symbol) if ARGS.symbol else None
+NEXTID = ARGS.order_id # Next order id shared by all accounts
+# Order books per account, orders indexed using order id
+BOOKS = defaultdict(dict)
+# Throughput and latency counters
+STATS = {'messages': 0, 'requests': 0, 'opened': 0, 'closed': 0, 'failed': 0,
+         'latency_total': 0.0, 'latency_max': 0.0}
+# Request latency distribution since the last stats log
+LATENCY = Histogram()
+
+class Journal:
+  """Append-only order journal with group commit and snapshot compaction.
+  Records are open, close and next id events each followed by a CRC32 so
+  that a torn write at the end of the file is detected on replay. Replies
+  are held until their records are fsynced, many requests share one fsync.
+  """
+  # kind, order_id, price, volume, type, account length + account + crc
+  RECORD = struct.Struct('<BQddBB')
+  CRC = struct.Struct('<I')
+  OPEN, CLOSE, NEXTID = 1, 2, 3
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.snapname = fname + '.snap'
+    self._buffer = list() # Encoded records not yet written
+    self._flushed = Event() # Signalled after every group commit
+    self._file = None
+    self._error = None # Exception of a failed commit if any
+
+  @classmethod
+  def encode(cls, kind, order_id, account=b'', price=0.0, volume=0.0, otype=0):
+    """Encode a single journal record."""
+    rec = cls.RECORD.pack(kind, order_id, price, volume, otype, len(account)) + account
+    return rec + cls.CRC.pack(zlib.crc32(rec))
+
+  @classmethod
+  def decode(cls, data):
+    """Decode records until the end or the first corrupt one.
+    :return: list of records and number of valid bytes
+    """
+    records, offset = list(), 0
+    while offset + cls.RECORD.size <= len(data):
+      kind, order_id, price, volume, otype, alen = cls.RECORD.unpack_from(data, offset)
+      end = offset + cls.RECORD.size + alen
+      if end + cls.CRC.size > len(data):
+        break
+      crc, = cls.CRC.unpack_from(data, end)
+      if crc != zlib.crc32(data[offset:end]):
+        break
+      records.append((kind, order_id, data[offset+cls.RECORD.size:end], price, volume, otype))
+      offset = end + cls.CRC.size
+    return records, offset
+
+  def replay(self):
+    """Rebuild order books from snapshot and journal files."""
+    global NEXTID # pylint: disable=global-statement
+    count = 0
+    for fname in (self.snapname, self.fname):
+      if not os.path.exists(fname):
+        continue
+      with open(fname, 'rb') as f:
+        data = f.read()
+      records, valid = self.decode(data)
+      if valid != len(data):
+        logger.warning("Discarding %s corrupt bytes at end of %s", len(data)-valid, fname)
+        with open(fname, 'r+b') as f:
+          f.truncate(valid)
+      # Replay is idempotent, journal may repeat snapshot events
+      for kind, order_id, account, price, volume, otype in records:
+        if kind == self.OPEN:
+          BOOKS[account][order_id] = Order(id=order_id, price=price, volume=volume, type=otype)
+        elif kind == self.CLOSE:
+          BOOKS[account].pop(order_id, None)
+        NEXTID = max(NEXTID, order_id+1)
+      count += len(records)
+    logger.info("Replayed %s journal records, %s open orders, next id %s",
+                count, sum(len(b) for b in BOOKS.values()), NEXTID)
+    self._file = open(self.fname, 'ab')
+
+  def append(self, record):
+    """Queue an encoded record for the next group commit."""
+    self._buffer.append(record)
+
+  def wait(self):
+    """Block the calling green thread until queued records are durable.
+    :raises: the exception of a failed commit
+    """
+    if self._error is not None:
+      raise self._error
+    if self._buffer:
+      self._flushed.wait()
+
+  def _sync(self, data):
+    """Write and fsync data, runs in a native thread."""
+    self._file.write(data)
+    self._file.flush()
+    os.fsync(self._file.fileno())
+
+  def compact(self):
+    """Write open orders into a snapshot and start a new journal.
+    Called by the commit loop so nothing is written to the journal
+    meanwhile. Orders are serialised before the first yield so the
+    snapshot matches the flushed journal, records queued while the
+    fsync yields go to the new journal with the next commit. A crash
+    before the new journal starts replays the old one after the
+    snapshot which is safe as replay is idempotent.
+    """
+    records = [self.encode(self.NEXTID, NEXTID-1)]
+    for account, orders in BOOKS.items():
+      records.extend(self.encode(self.OPEN, o.id, account, o.price, o.volume, o.type)
+                     for o in orders.values())
+    tmpname = self.snapname + '.tmp'
+    with open(tmpname, 'wb') as f:
+      f.write(b''.join(records))
+      f.flush()
+      tpool.execute(os.fsync, f.fileno())
+    os.replace(tmpname, self.snapname)
+    # Events in the old journal are now covered by the snapshot
+    self._file.close()
+    self._file = open(self.fname, 'wb')
+    logger.info("Compacted journal into snapshot of %s records.", len(records))
+
+  def run(self):
+    """Group commit queued records periodically."""
+    limit = ARGS.journal_compact*1024*1024
+    while True:
+      sleep(ARGS.journal_interval/1000)
+      if not self._buffer:
+        continue
+      # Records queued while writing wait for the next commit
+      data, self._buffer = b''.join(self._buffer), list()
+      flushed, self._flushed = self._flushed, Event()
+      try:
+        tpool.execute(self._sync, data)
+      except Exception as e: # pylint: disable=broad-except
+        flushed.send_exception(e)
+        self._fail(e)
+      # Release replies waiting for this commit
+      flushed.send()
+      if self._file.tell() > limit:
+        try:
+          self.compact()
+        except Exception as e: # pylint: disable=broad-except
+          self._fail(e)
+
+  def _fail(self, error):
+    """Fail waiting replies and stop the broker.
+    Order books in memory are ahead of the journal once a commit fails,
+    carrying on would acknowledge orders that are lost on restart.
+    """
+    logger.critical("Journal commit failed, stopping broker: %s", error)
+    self._error = error
+    self._flushed.send_exception(error)
+    # Let workers send their failure replies
+    sleep(0.1)
+    # Exits the process from the main green thread
+    raise SystemExit(1)
+
+JOURNAL = Journal(ARGS.journal) if ARGS.journal else None
+
+def account_of(identity):
+  """Account of a client from its socket identity.
+  Clients may set their identity as account/connection so that several
+  connections share a book, auto generated identities share the default one.
+  """
+  if not identity or identity[:1] == b'\x00':
+    return b''
+  return identity.split(b'/', 1)[0]
 
 def handle_tick():
   """Listen to incoming tick updates."""
   socket = context.socket(zmq.SUB)
   # Set topic filter, this is a binary prefix
   # to check for each incoming message
-  # set from server as uchar topic = X
-  # We'll subsribe to only tick updates for now
-  socket.setsockopt(zmq.SUBSCRIBE, bytes.fromhex('00'))
+  # We'll subsribe to only tick updates of the traded symbol
+  socket.setsockopt(zmq.SUBSCRIBE, protocol.topic(protocol.TICK, SYMBOL))
   logger.info("Connecting to ticker: %s", ARGS.ticker)
   socket.connect(ARGS.ticker)
   while True:
-    raw = socket.recv()
-    # unpack bytes https://docs.python.org/3/library/struct.html
-    bid, ask = struct.unpack_from('dd', raw, 1) # offset topic
-    logger.debug("Tick: %f %f", bid, ask)
+    frame = protocol.decode(socket.recv())
+    if frame is None:
+      logger.warning("Malformed ticker message.")
+      continue
+    # Only the latest tick of a batch matters for execution
+    bid, ask = protocol.last(frame)
+    logger.debug("Tick: %s %f %f", protocol.symbol_name(frame.symbol), bid, ask)
     # We'll use global to pass tick data between green threads
     # since only 1 actually run at a time
-    global BID, ASK # pylint: disable=global-statement
-    BID, ASK = bid, ask
+    PRICES[frame.symbol] = PRICES[None] = (bid, ask)
   # socket will be cleaned up at garbarge collection
 
+def handle_request(account, order_id, volume, action):
+  """Execute a single broker request against an account order book.
+  :return: response tuple
+  """
+  orders = BOOKS[account]
+  global NEXTID # pylint: disable=global-statement
+  bid, ask = PRICES.get(SYMBOL, (0.0, 0.0))
+  # Prepare response: ulong order_id, double price, double profit, uint retcode
+  resp = (order_id, 0.0, 0.0, 1) # Assume failure
+  if action == 1 and order_id in orders and bid and ask: # Close order
+    # BIG ASSUMPTION, account currency is the same as base currency
+    # Ex. GBP account trading on GBPUSD since we don't have other
+    # exchange rates streaming to us to handle conversion
+    order = orders.pop(order_id)
+    closep = bid if order.type == 2 else ask
+    diff = closep - order.price if order.type == 2 else order.price - closep
+    resp = (order_id, closep, round(profit(diff, closep, order.volume, ARGS.leverage), 2), 0)
+    if JOURNAL:
+      JOURNAL.append(Journal.encode(Journal.CLOSE, order_id, account))
+    STATS['closed'] += 1
+    logger.info("CLOSING: %s", resp)
+  elif action in (2, 3): # Buy - Sell
+    oprice = ask if action == 2 else bid
+    order = Order(id=NEXTID, price=oprice, volume=volume, type=action)
+    orders[NEXTID] = order
+    if JOURNAL:
+      JOURNAL.append(Journal.encode(Journal.OPEN, NEXTID, account, oprice, volume, action))
+    STATS['opened'] += 1
+    logger.info("ORDER: %s", order)
+    resp = (NEXTID, oprice, 0.0, 0)
+    NEXTID += 1
+  else:
+    # Unknown action otherwise
+    STATS['failed'] += 1
+  return resp
+
+def handle_message(identity, raw):
+  """Handle one client message of one or more requests.
+  :return: packed responses
+  """
+  if not raw or len(raw) % REQUEST.size:
+    logger.error("Malformed request of %s bytes.", len(raw))
+    STATS['failed'] += 1
+    return RESPONSE.pack(0, 0.0, 0.0, 1)
+  account = account_of(identity)
+  # A message carries one or more requests back to back
+  resps = list()
+  for order_id, volume, action in REQUEST.iter_unpack(raw):
+    resps.append(RESPONSE.pack(*handle_request(account, order_id, volume, action)))
+    STATS['requests'] += 1
+  return b''.join(resps)
+
+def failures(raw):
+  """Packed failure responses, one per request if they can be counted."""
+  return RESPONSE.pack(0, 0.0, 0.0, 1)*max(len(raw)//REQUEST.size, 1)
+
+def handle_worker(socket, queue):
+  """Handle queued client messages and reply."""
+  while True:
+    received, frames = queue.get()
+    # REQ clients send an empty delimiter, DEALER clients may not
+    try:
+      resp = handle_message(frames[0], frames[-1])
+    except Exception: # pylint: disable=broad-except
+      logger.exception("Failed to handle request.")
+      resp = RESPONSE.pack(0, 0.0, 0.0, 1)
+    if JOURNAL:
+      # Only acknowledge once the orders are durable
+      try:
+        JOURNAL.wait()
+      except Exception: # pylint: disable=broad-except
+        resp = failures(frames[-1])
+    socket.send_multipart(frames[:-1] + [resp])
+    latency = time.perf_counter_ns() - received
+    LATENCY.record(latency)
+    STATS['messages'] += 1
+    STATS['latency_total'] += latency/1e9
+    STATS['latency_max'] = max(STATS['latency_max'], latency/1e9)
+
 def handle_broker():
-  """Listen to incoming broker requests."""
-  socket = context.socket(zmq.REP)
+  """Listen to incoming broker requests from many clients."""
+  socket = context.socket(zmq.ROUTER)
   socket.bind(ARGS.broker_host)
   logger.info("Broker listening on: %s", ARGS.broker_host)
-  nextid = ARGS.order_id
+  queue = LightQueue()
+  for _ in range(ARGS.workers):
+    pool.spawn_n(handle_worker, socket, queue)
   while True:
-    raw = socket.recv()
-    # Prepare request: ulong order_id, double volume, uchar action
-    order_id, volume, action = struct.unpack('LdB', raw)
-    # Prepare response: ulong order_id, double price, double profit, uint retcode
-    resp = (order_id, 0.0, 0.0, 1) # Assume failure
-    if action == 1 and order_id in ORDERS: # Close order
-      # BIG ASSUMPTION, account currency is the same as base currency
-      # Ex. GBP account trading on GBPUSD since we don't have other
-      # exchange rates streaming to us to handle conversion
-      order = ORDERS.pop(order_id)
-      closep = BID if order.type == 2 else ASK
-      diff = closep - order.price if order.type == 2 else order.price - closep
-      profit = diff*ARGS.leverage*order.volume*1000*(1/closep)
-      resp = (order_id, closep, round(profit, 2), 0)
-      logger.info("CLOSING: %s", resp)
-    elif action in (2, 3): # Buy - Sell
-      oprice = ASK if action == 2 else BID
-      order = Order(id=nextid, price=oprice, volume=volume, type=action)
-      ORDERS[nextid] = order
-      logger.info("ORDER: %s", order)
-      resp = (nextid, oprice, 0.0, 0)
-      nextid += 1
-    # Unknown action otherwise
-    # Pack and send response
-    resp = struct.pack('LddI', *resp)
-    socket.send(resp)
+    frames = socket.recv_multipart()
+    queue.put((time.perf_counter_ns(), frames))
+
+def handle_stats():
+  """Periodically log throughput and latency counters."""
+  last = dict(STATS)
+  while True:
+    sleep(ARGS.stats)
+    messages = STATS['messages'] - last['messages']
+    latency = STATS['latency_total'] - last['latency_total']
+    logger.info("STATS: %.1f msg/s %.1f req/s avg %.3fms p50 %.3fms p99 %.3fms max %.3fms accounts %s open %s",
+                messages/ARGS.stats, (STATS['requests'] - last['requests'])/ARGS.stats,
+                latency/messages*1000 if messages else 0.0,
+                LATENCY.percentile(50)/1e6, LATENCY.percentile(99)/1e6, STATS['latency_max']*1000,
+                len(BOOKS), sum(len(b) for b in BOOKS.values()))
+    last = dict(STATS)
+    STATS['latency_max'] = 0.0
+    LATENCY.reset()
 
 # Spawn green threads
 logging.basicConfig(level=logging.INFO)
 pool = GreenPool()
 try:
+  if JOURNAL:
+    JOURNAL.replay()
+    pool.spawn_n(JOURNAL.run)
   pool.spawn_n(handle_tick)
   pool.spawn_n(handle_broker)
+  if ARGS.stats > 0:
+    pool.spawn_n(handle_stats)
   pool.waitall() # Loops forever
 finally:
   # There might some orphan orders left over
-  print("ORPHANS:", ORDERS)
+  print("ORPHANS:", {k.decode(errors='replace'): v for k, v in BOOKS.items() if v})
+  print("STATS:", STATS)
@@ -0,0 +1,75 @@
+"""Concurrent login benchmark for a running pedlarweb server."""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import uuid
+
+import requests
+
+# Designed to run locally only
+if __name__ != "__main__":
+  raise RuntimeError("Can only run as stand-alone script.")
+
+# Setup Arguments
+parser = argparse.ArgumentParser(description=__doc__, fromfile_prefix_chars='@')
+parser.add_argument("-e", "--endpoint", default="http://localhost:5000", help="Pedlar web endpoint.")
+parser.add_argument("-n", "--logins", default=200, type=int, help="Number of logins.")
+parser.add_argument("-c", "--concurrency", default=200, type=int, help="Logins made at the same time.")
+parser.add_argument("-i", "--interval", default=0.01, type=float, help="Seconds between responsiveness probes.")
+ARGS = parser.parse_args()
+
+def percentiles(values):
+  """Format p50, p99 and max of values in milliseconds."""
+  if not values:
+    return "no samples"
+  values = sorted(values)
+  return "p50 {:.1f}ms p99 {:.1f}ms max {:.1f}ms".format(
+    values[len(values)//2]*1000, values[min(len(values)-1, len(values)*99//100)]*1000,
+    values[-1]*1000)
+
+def login(username):
+  """Obtain an API token, creating the user on first login.
+  :return: seconds taken
+  """
+  start = time.perf_counter()
+  r = requests.post(ARGS.endpoint+"/api/token", json={'username': username, 'password': "benchmark"})
+  r.raise_for_status()
+  return time.perf_counter() - start
+
+def probe(stop, latencies):
+  """Time a page without hashing to see if the server stalls."""
+  session = requests.Session()
+  while not stop.is_set():
+    start = time.perf_counter()
+    session.get(ARGS.endpoint+"/login")
+    latencies.append(time.perf_counter() - start)
+    time.sleep(ARGS.interval)
+
+def storm(usernames):
+  """Login all users concurrently while probing responsiveness."""
+  stop, latencies = threading.Event(), list()
+  prober = threading.Thread(target=probe, args=(stop, latencies))
+  prober.start()
+  start = time.perf_counter()
+  with ThreadPoolExecutor(ARGS.concurrency) as pool:
+    times = list(pool.map(login, usernames))
+  elapsed = time.perf_counter() - start
+  stop.set()
+  prober.join()
+  return elapsed, times, latencies
+
+def main():
+  """Probe idle responsiveness then login new and existing users."""
+  stop_idle, idle = threading.Event(), list()
+  threading.Timer(1.0, stop_idle.set).start()
+  probe(stop_idle, idle)
+  print("idle probe:    ", percentiles(idle))
+  users = ["bench-" + uuid.uuid4().hex[:8] for _ in range(ARGS.logins)]
+  for name in ("new users", "existing users"):
+    elapsed, times, latencies = storm(users)
+    print("-- {}: {:.1f} logins/s".format(name, len(users)/elapsed))
+    print("login:         ", percentiles(times))
+    print("probe:         ", percentiles(latencies))
+
+main()
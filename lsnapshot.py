@@ -0,0 +1,80 @@
+"""Ticker snapshot service for agents to recover missed ticks."""
+import argparse
+from collections import deque
+import logging
+from eventlet import GreenPool
+from eventlet.green import zmq
+
+from pedlar import protocol
+
+# Designed to run locally only
+if __name__ != "__main__":
+  raise RuntimeError("Can only run as stand-alone script.")
+
+# Setup Arguments
+logger = logging.getLogger(__name__)
+parser = argparse.ArgumentParser(description=__doc__, fromfile_prefix_chars='@')
+parser.add_argument("-t", "--ticker", default="tcp://127.0.0.1:7000", help="Ticker URL")
+parser.add_argument("-s", "--snapshot_host", default="tcp://127.0.0.1:7001", help="Snapshot serve URL")
+parser.add_argument("-n", "--size", default=1000, type=int, help="Number of records kept per type and symbol")
+ARGS = parser.parse_args()
+
+# Context are thread safe already,
+# we'll create one global one for all sockets
+context = zmq.Context()
+
+# Recent messages per topic as (first sequence, last sequence, raw message)
+HISTORY = dict()
+# Number of records kept per topic
+RECORDS = dict()
+
+def handle_ticker():
+  """Keep the most recent sequenced messages of every topic."""
+  socket = context.socket(zmq.SUB)
+  socket.setsockopt(zmq.SUBSCRIBE, bytes())
+  logger.info("Connecting to ticker: %s", ARGS.ticker)
+  socket.connect(ARGS.ticker)
+  while True:
+    raw = socket.recv()
+    frame = protocol.decode(raw)
+    if frame is None or not frame.sequence:
+      # Legacy messages cannot be recovered by sequence
+      continue
+    topic = protocol.topic(frame.type, frame.symbol)
+    history = HISTORY.setdefault(topic, deque())
+    if history and frame.sequence <= history[-1][1]:
+      # Publisher restarted, older messages are no longer comparable
+      history.clear()
+      RECORDS[topic] = 0
+    count = protocol.count(frame)
+    history.append((frame.sequence, frame.sequence + count - 1, raw))
+    RECORDS[topic] = RECORDS.get(topic, 0) + count
+    # Drop whole messages while enough records remain
+    while RECORDS[topic] - (history[0][1] - history[0][0] + 1) >= ARGS.size:
+      first, last, _ = history.popleft()
+      RECORDS[topic] -= last - first + 1
+
+def handle_snapshot():
+  """Reply with stored messages after the requested sequence."""
+  socket = context.socket(zmq.ROUTER)
+  socket.bind(ARGS.snapshot_host)
+  logger.info("Snapshot listening on: %s", ARGS.snapshot_host)
+  while True:
+    frames = socket.recv_multipart()
+    try:
+      topic, after = protocol.SNAPSHOT.unpack(frames[-1])
+    except Exception: # pylint: disable=broad-except
+      logger.error("Malformed snapshot request of %s bytes.", len(frames[-1]))
+      socket.send_multipart(frames[:-1] + [b''])
+      continue
+    raws = [raw for _, last, raw in HISTORY.get(topic, ()) if last > after]
+    logger.debug("Snapshot of %s messages after %s", len(raws), after)
+    # An empty frame when there is nothing to recover
+    socket.send_multipart(frames[:-1] + (raws or [b'']))
+
+# Spawn green threads
+logging.basicConfig(level=logging.INFO)
+pool = GreenPool()
+pool.spawn_n(handle_ticker)
+pool.spawn_n(handle_snapshot)
+pool.waitall() # Loops forever
@@ -1,13 +1,16 @@
 """mt5 zmq test client."""
 import argparse
-from collections import namedtuple
+from collections import namedtuple, deque
 import logging
-import re
-import struct
+import time
 
 import requests
 import zmq
 
+from . import protocol
+from .execution import Execution
+from .metrics import Metrics
+
 logger = logging.getLogger(__name__)
 logger.info("libzmq: %s", zmq.zmq_version())
 logger.info("pyzmq: %s", zmq.pyzmq_version())
@@ -25,22 +28,53 @@ class Agent:
   """Base class for Pedlar trading agent."""
   name = "agent"
   polltimeout = 2000 # milliseconds
-  csrf_re = re.compile('name="csrf_token" type="hidden" value="(.+)"')
+  replay_chunk = 65536 # rows converted at a time when backtesting
+  batch_size = protocol.MAX_BATCH # maximum number of requests sent together
+  channel_timeout = 4000 # milliseconds to wait for trading channel response
 
   def __init__(self, backtest=None, username="nobody", password="",
                ticker="tcp://localhost:7000",
-               endpoint="http://localhost:5000"):
+               endpoint="http://localhost:5000",
+               transport="http", channel="tcp://localhost:7200",
+               symbols=None, snapshot=None, metrics=0, execution=None):
+    if self.batch_size > protocol.MAX_BATCH:
+      raise ValueError("Batch size exceeds {} requests of the broker.".format(protocol.MAX_BATCH))
     self.backtest = backtest # backtesting file in any
     self._last_tick = (0.0, 0.0) # last tick price for backtesting
     self._last_order_id = 0 # auto increment id for backtesting
+    if not isinstance(execution, Execution):
+      execution = Execution.from_specs(execution or list())
+    self.execution = execution # Fill model for backtesting
+    self._queued = deque() # Backtest (tick index, time, function, args) decisions waiting to fill
+    self._filling = False # Executing queued backtest decisions
+    self._tick_index = -1 # Backtest tick number
+    self._tick_time = 0 # Backtest tick time in nanoseconds
     self.username = username # pedlarweb username
     self.password = password # pedlarweb password
     self.endpoint = endpoint # pedlarweb endpoint
     self._session = None # pedlarweb requests Session
+    self._token = None # pedlarweb API token
+    self.transport = transport # http or zmq for trade requests
+    self.channel = channel # pedlarweb trading channel url
+    self._channel_socket = None # Trading channel socket
     self.ticker = ticker # Ticker url
+    self.symbols = list(symbols or list()) # Subscribed symbol names, all if empty
     self._poller = None # Ticker socket polling object
+    self.snapshot = snapshot # Ticker snapshot url to recover missed ticks if any
+    self._snapshot_socket = None # Ticker snapshot socket
+    self._sequences = protocol.Sequences() # Ticker sequence tracking
+    self.stats = {'messages': 0, 'gaps': 0, 'missed': 0, 'recovered': 0,
+                  'latency': 0.0, 'latency_max': 0.0} # Ticker stream statistics
     self.orders = dict() # Orders indexed using order id
     self.balance = 0.0 # Local session balance
+    self.trades = 0 # Number of closed orders
+    self._peak = 0.0 # Highest balance reached
+    self.drawdown = 0.0 # Maximum drawdown of balance
+    self._bars = list() # Bar aggregators with handler and symbol
+    self.metrics = Metrics() if metrics else None # Latency histograms if enabled
+    self._metrics_interval = metrics # Seconds between metrics dumps
+    self._metrics_dumped = time.monotonic() # Time of last metrics dump
+    self._tick_received = 0 # perf_counter_ns of last tick if metrics enabled
 
   @classmethod
   def from_args(cls, parents=None):
@@ -53,66 +87,183 @@ class Agent:
     parser.add_argument("-p", "--password", default="", help="Pedlar Web password.")
     parser.add_argument("-t", "--ticker", default="tcp://localhost:7000", help="Ticker endpoint.")
     parser.add_argument("-e", "--endpoint", default="http://localhost:5000", help="Pedlar Web endpoint.")
+    parser.add_argument("--transport", default="http", choices=["http", "zmq"], help="Trade request transport.")
+    parser.add_argument("-c", "--channel", default="tcp://localhost:7200", help="Pedlar Web trading channel endpoint.")
+    parser.add_argument("-s", "--snapshot", help="Ticker snapshot endpoint to recover missed ticks.")
+    parser.add_argument("-m", "--metrics", default=0, type=float,
+                        help="Seconds between latency metrics logs, 0 to disable.")
+    parser.add_argument("-x", "--execution", nargs="*", default=list(),
+                        help="Backtest execution model, ex. latency=2 cross_spread=True commission=0.1")
+    parser.add_argument("-y", "--symbols", nargs="*", default=list(),
+                        help="Symbols to receive updates for, all if not given.")
     return cls(**vars(parser.parse_args()))
 
   def connect(self):
     """Attempt to connect pedlarweb and ticker endpoints."""
     #-- pedlarweb connection
-    # We will adapt to the existing web login rather than
-    # creating a new api endpoint for agent requests
+    # An API token is issued once and sent with every trade request
     logger.info("Attempting to login to Pedlar web.")
     _session = requests.Session()
+    payload = {'username': self.username, 'password': self.password}
     try:
-      r = _session.get(self.endpoint+"/login") # CSRF protected
-      r.raise_for_status()
+      r = _session.post(self.endpoint+"/api/token", json=payload)
     except:
       logger.critical("Failed to connect to Pedlar web.")
       raise RuntimeError("Connection to Pedlar web failed.")
-    try:
-      csrf_token = self.csrf_re.search(r.text).group(1)
-    except AttributeError:
-      raise Exception("Could not find CSRF token in auth.")
-    payload = {'username': self.username, 'password': self.password,
-               'csrf_token': csrf_token}
-    r = _session.post(self.endpoint+"/login", data=payload, allow_redirects=False)
-    r.raise_for_status()
-    if not r.is_redirect or not r.headers['Location'].endswith('/'):
+    if r.status_code != 200:
       raise Exception("Failed login into Pedlar web.")
+    self._token = r.json()['token']
+    _session.headers['Authorization'] = "Bearer " + self._token
     self._session = _session
     logger.info("Pedlar web authentication successful.")
+    if self.transport == "zmq":
+      self._channel_connect()
     #-- ticker connection
     socket = context.socket(zmq.SUB)
-    # Set topic filter, this is a binary prefix
-    # to check for each incoming message
-    # set from server as uchar topic = X
-    # We'll subsribe to everything for now
-    socket.setsockopt(zmq.SUBSCRIBE, bytes())
-    # socket.setsockopt(zmq.SUBSCRIBE, bytes.fromhex('00'))
+    self._subscribe(socket)
     logger.info("Connecting to ticker: %s", self.ticker)
     socket.connect(self.ticker)
     self._poller = zmq.Poller()
     self._poller.register(socket, zmq.POLLIN)
+    if self.snapshot:
+      self._snapshot_connect()
+
+  def _snapshot_connect(self):
+    """Connect to ticker snapshot service."""
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.RCVTIMEO, self.polltimeout)
+    socket.setsockopt(zmq.LINGER, 0)
+    logger.info("Connecting to ticker snapshot: %s", self.snapshot)
+    socket.connect(self.snapshot)
+    self._snapshot_socket = socket
+
+  def _subscribe(self, socket):
+    """Subscribe ticker socket to updates of agent symbols."""
+    # Set topic filter, this is a binary prefix
+    # to check for each incoming message
+    if not self.symbols:
+      # Subscribe to everything
+      socket.setsockopt(zmq.SUBSCRIBE, bytes())
+    for symbol in self.symbols:
+      sid = protocol.symbol_id(symbol)
+      socket.setsockopt(zmq.SUBSCRIBE, protocol.topic(protocol.TICK, sid))
+      socket.setsockopt(zmq.SUBSCRIBE, protocol.topic(protocol.BAR, sid))
 
   def disconnect(self):
     """Close server connection gracefully in any."""
     # Clean up remaining orders
     self.close()
-    # Ease the burden on server and logout
+    if self._channel_socket is not None:
+      self._channel_socket.close()
+      self._channel_socket = None
+    if self._snapshot_socket is not None:
+      self._snapshot_socket.close()
+      self._snapshot_socket = None
+    # Ease the burden on server and revoke token
     logger.info("Logging out of Pedlar web.")
-    r = self._session.get(self.endpoint+"/logout", allow_redirects=False)
-    if not r.is_redirect:
+    r = self._session.delete(self.endpoint+"/api/token")
+    if r.status_code != 204:
       logger.warning("Could not logout from Pedlar web.")
 
   def on_order(self, order):
     """Called on successful order."""
     pass
 
+  def _channel_connect(self):
+    """Connect to pedlarweb trading channel."""
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.RCVTIMEO, self.channel_timeout)
+    socket.setsockopt(zmq.LINGER, 0)
+    logger.info("Connecting to trading channel: %s", self.channel)
+    socket.connect(self.channel)
+    self._channel_socket = socket
+
+  def _channel_frames(self, reqs):
+    """Token, agent name and packed requests frames for the trading channel."""
+    # Trading channel uses the broker binary format
+    return [self._token.encode(), self.name.encode(), protocol.pack_requests(reqs)]
+
+  @staticmethod
+  def _channel_responses(reqs, raw):
+    """Unpack trading channel responses.
+    :return: list of responses, failed ones have non-zero retcode
+    """
+    resps = protocol.unpack_responses(raw)
+    if len(resps) != len(reqs):
+      # Whole message failed with a status code
+      logger.error("Pedlar web communication error: %s", resps[0]['retcode'] if resps else raw)
+      raise IOError("Pedlar web server communication error.")
+    return resps
+
+  def _channel_talk(self, reqs):
+    """Send requests over the trading channel in a single round trip.
+    :return: list of responses, failed ones have non-zero retcode
+    """
+    try:
+      self._channel_socket.send_multipart(self._channel_frames(reqs))
+      raw = self._channel_socket.recv()
+    except zmq.ZMQError as e:
+      # REQ socket cannot be reused after a missing response
+      logger.error("Pedlar web communication error: %s", str(e))
+      self._channel_socket.close()
+      self._channel_connect()
+      raise IOError("Pedlar web server communication error.")
+    return self._channel_responses(reqs, raw)
+
+  def _decided(self):
+    """Record time from the last tick to its first order decision.
+    :return: decision timestamp to pass to _filled, 0 if disabled
+    """
+    if not self.metrics:
+      return 0
+    now = time.perf_counter_ns()
+    if self._tick_received:
+      self.metrics.record('tick_to_decision', now - self._tick_received)
+      self._tick_received = 0
+    return now
+
+  def _filled(self, decided):
+    """Record time from an order decision to its confirmation."""
+    if decided:
+      self.metrics.record('decision_to_fill', time.perf_counter_ns() - decided)
+
+  def _dump_metrics(self):
+    """Log latency metrics if the interval passed."""
+    now = time.monotonic()
+    if now - self._metrics_dumped >= self._metrics_interval:
+      self._metrics_dumped = now
+      logger.info("Latency metrics (us): %s", self.metrics.snapshot())
+
   def talk(self, order_id=0, volume=0.01, action=0):
     """Make a request response attempt to Pedlar web."""
     payload = {'order_id': order_id, 'volume': volume, 'action': action,
                'name': self.name}
+    if self.transport == "zmq":
+      resp = self._channel_talk([payload])[0]
+      if resp['retcode'] != 0:
+        logger.error("Pedlar web communication error: %s", resp['retcode'])
+        raise IOError("Pedlar web server communication error.")
+      return resp
+    try:
+      r = self._session.post(self.endpoint+'/api/trade', json=payload)
+      r.raise_for_status()
+      resp = r.json()
+    except Exception as e:
+      logger.error("Pedlar web communication error: %s", str(e))
+      raise IOError("Pedlar web server communication error.")
+    return resp
+
+  def talk_many(self, reqs):
+    """Send many requests to Pedlar web in a single round trip.
+    :param reqs: list of dictionaries with order_id, volume and action
+    :return: list of responses, failed ones have non-zero retcode
+    """
+    if self.transport == "zmq":
+      return self._channel_talk(reqs)
+    payload = [dict({'order_id': 0, 'volume': 0.01, 'action': 0}, name=self.name, **r)
+               for r in reqs]
     try:
-      r = self._session.post(self.endpoint+'/trade', json=payload)
+      r = self._session.post(self.endpoint+'/api/trade', json=payload)
       r.raise_for_status()
       resp = r.json()
     except Exception as e:
@@ -122,6 +273,8 @@ class Agent:
 
   def _place_order(self, otype="buy", volume=0.01, single=True, reverse=True):
     """Place a buy or a sell order."""
+    if self._delay(self._place_order, otype, volume, single, reverse):
+      return
     ootype = "sell" if otype == "buy" else "buy" # Opposite order type
     if (reverse and
         not self.close([oid for oid, o in self.orders.items() if o.type == ootype])):
@@ -132,22 +285,70 @@ class Agent:
       return
     # Request the actual order
     logger.info("Placing a %s order.", otype)
+    if self.backtest:
+      # Place order locally
+      self._backtest_open(otype, volume)
+      return
+    decided = self._decided()
     try:
-      if self.backtest:
-        # Place order locally
-        bidaskidx = 0 if otype == "buy" else 1
-        order = Order(id=self._last_order_id+1, price=self._last_tick[bidaskidx],
-                      volume=volume, type=otype)
-      else:
-        # Contact pedlarweb
-        resp = self.talk(volume=volume, action=2 if otype == "buy" else 3)
-        order = Order(id=resp['order_id'], price=resp['price'], volume=volume, type=otype)
+      # Contact pedlarweb
+      resp = self.talk(volume=volume, action=2 if otype == "buy" else 3)
+      order = Order(id=resp['order_id'], price=resp['price'], volume=volume, type=otype)
+      self._filled(decided)
       self._last_order_id = order.id
       self.orders[order.id] = order
       self.on_order(order)
     except Exception as e:
       logger.error("Failed to place %s order: %s", otype, str(e))
 
+  def _delay(self, func, *args):
+    """Queue a backtest order decision until the execution latency passed.
+    Decisions are made against the orders open when they fill as the
+    positions of vectorised backtests.
+    :return: true if queued false if it should execute now
+    """
+    if not self.backtest or not self.execution.delayed or self._filling:
+      return False
+    index, time_due = self.execution.due(self._tick_index, self._tick_time)
+    self._queued.append((index, time_due, func, args))
+    return True
+
+  def _fill_queued(self):
+    """Execute queued backtest decisions due at the current tick."""
+    self._filling = True
+    try:
+      while (self._queued and self._queued[0][0] <= self._tick_index and
+             (not self._tick_time or self._queued[0][1] <= self._tick_time)):
+        _, _, func, args = self._queued.popleft()
+        func(*args)
+    finally:
+      self._filling = False
+
+  def _backtest_open(self, otype, volume):
+    """Open an order locally at the current tick."""
+    volume = self.execution.fill_volume(volume)
+    used = sum(self.execution.margin(o.volume) for o in self.orders.values())
+    if volume <= 0 or not self.execution.allows(self.balance, used, volume):
+      logger.warning("Not enough margin for a %s order.", otype)
+      return
+    bid, ask = self._last_tick
+    order = Order(id=self._last_order_id+1, type=otype, volume=volume,
+                  price=self.execution.open_price(otype == "buy", bid, ask, volume))
+    self._last_order_id = order.id
+    self.orders[order.id] = order
+    self.on_order(order)
+
+  def _backtest_close(self, oid):
+    """Close an order locally at the current tick."""
+    order = self.orders.pop(oid)
+    buy = order.type == "buy"
+    bid, ask = self._last_tick
+    closep = self.execution.close_price(buy, bid, ask, order.volume)
+    profit = round(self.execution.profit(buy, order.price, closep, order.volume), 2)
+    logger.info("Closed order %s with profit %s", oid, profit)
+    self._update_balance(profit)
+    self.on_order_close(order, profit)
+
   def buy(self, volume=0.01, single=True, reverse=True):
     """Place a new buy order and store it in self.orders
     :param volume: size of trade
@@ -164,6 +365,13 @@ class Agent:
     """
     self._place_order(otype="sell", volume=volume, single=single, reverse=reverse)
 
+  def _update_balance(self, profit):
+    """Update balance and trade statistics with closed order profit."""
+    self.balance += profit
+    self.trades += 1
+    self._peak = max(self._peak, self.balance)
+    self.drawdown = max(self.drawdown, self._peak - self.balance)
+
   def on_order_close(self, order, profit):
     """Called on successfull order close."""
     pass
@@ -173,31 +381,57 @@ class Agent:
     :param order_ids: only close these orders
     :return: true on success false otherwise
     """
+    if self._delay(self.close, order_ids):
+      return True
     oids = order_ids if order_ids is not None else list(self.orders.keys())
+    decided = 0 if self.backtest or not oids else self._decided()
+    if not self.backtest and len(oids) > 1:
+      # Close many orders with as few requests as possible
+      success = self._close_many(oids)
+      self._filled(decided)
+      return success
     for oid in oids:
       if self.backtest:
         # Execute order locally
-        order = self.orders.pop(oid)
-        closep = self._last_tick[0 if order.type == "buy" else 1]
-        diff = closep - order.price if order.type == "buy" else order.price - closep
-        # Assume 100 for leverage for now
-        profit = round(diff*100*order.volume*1000*(1/closep), 2)
-        logger.info("Closed order %s with profit %s", oid, profit)
-        self.balance += profit
-        self.on_order_close(order, profit)
+        self._backtest_close(oid)
       else:
         # Contact pedlarweb
         try:
           resp = self.talk(order_id=oid, action=1)
-          order = self.orders.pop(oid)
-          logger.info("Closed order %s with profit %s", oid, resp['profit'])
-          self.balance += resp['profit']
-          self.on_order_close(order, resp['profit'])
+          self._closed(oid, resp)
         except Exception as e:
           logger.error("Failed to close order %s: %s", oid, str(e))
           return False
+    self._filled(decided)
     return True
 
+  def _closed(self, oid, resp):
+    """Update state with successful close response."""
+    order = self.orders.pop(oid)
+    logger.info("Closed order %s with profit %s", oid, resp['profit'])
+    self._update_balance(resp['profit'])
+    self.on_order_close(order, resp['profit'])
+
+  def _close_many(self, oids):
+    """Close given orders in batches of requests.
+    :return: true if all orders closed false otherwise
+    """
+    success = True
+    for i in range(0, len(oids), self.batch_size):
+      batch = oids[i:i+self.batch_size]
+      try:
+        resps = self.talk_many([{'order_id': oid, 'action': 1} for oid in batch])
+      except Exception as e:
+        logger.error("Failed to close orders %s: %s", batch, str(e))
+        return False
+      for oid, resp in zip(batch, resps):
+        if resp['retcode'] != 0:
+          logger.error("Failed to close order %s: %s", oid, resp['retcode'])
+          success = False
+          continue
+        self._closed(oid, resp)
+    return success
+
   def on_tick(self, bid, ask):
     """Called on every tick update.
     :param bid: latest bid price
@@ -214,6 +448,112 @@ class Agent:
     """
     pass
 
+  def add_bars(self, bars, handler=None, symbol=None):
+    """Aggregate ticks into bars and call handler on every completed bar.
+    Bars are built from bid prices, when backtesting they are computed
+    at once from the whole file. Time bars need tick times which are
+    not recorded in CSV backtest files.
+    :param bars: aggregator from pedlar.bars such as TimeBars(60)
+    :param handler: called with bopen, bhigh, blow, bclose, on_bar if None
+    :param symbol: only aggregate ticks of this symbol
+    """
+    # Compare ids as names are only known for symbols seen by symbol_id
+    sid = None if symbol is None else protocol.symbol_id(symbol)
+    self._bars.append((bars, handler or self.on_bar, sid))
+
+  def _update_bars(self, sid, bid, timestamp):
+    """Feed a live tick of a symbol id to bar aggregators."""
+    for bars, handler, bsid in self._bars:
+      if bsid is not None and bsid != sid:
+        continue
+      bar = bars.update(bid, timestamp)
+      if bar is not None:
+        handler(*bar)
+
+  def on_symbol_tick(self, symbol, bid, ask):
+    """Called on every tick update with its symbol.
+    Override to follow several symbols, calls on_tick by default.
+    :param symbol: symbol name such as EURUSD, empty for unnamed tickers
+    """
+    self.on_tick(bid, ask)
+
+  def on_symbol_bar(self, symbol, bopen, bhigh, blow, bclose):
+    """Called on every last bar update with its symbol.
+    Override to follow several symbols, calls on_bar by default.
+    :param symbol: symbol name such as EURUSD, empty for unnamed tickers
+    """
+    self.on_bar(bopen, bhigh, blow, bclose)
+
+  def on_ticks(self, bids, asks):
+    """Called once with the whole tick series when backtesting.
+    Override to compute signals over the entire series at once,
+    fills and profits are then simulated vectorially.
+    :param bids: array of bid prices
+    :param asks: array of asking prices
+    :return: array of signals from pedlar.backtest or None to replay every tick
+    """
+    return None
+
+  def _recover(self, frame, after):
+    """Fetch and dispatch records missed before a frame from the snapshot service.
+    :param after: last sequence seen before the gap
+    """
+    request = protocol.SNAPSHOT.pack(protocol.topic(frame.type, frame.symbol), after)
+    try:
+      self._snapshot_socket.send(request)
+      raws = self._snapshot_socket.recv_multipart()
+    except zmq.ZMQError as e:
+      # REQ socket cannot be reused after a missing response
+      logger.warning("Could not recover missed ticks: %s", str(e))
+      self._snapshot_socket.close()
+      self._snapshot_connect()
+      return
+    for raw in raws:
+      missed = protocol.decode(raw) if raw else None
+      if missed is not None:
+        missed = protocol.between(missed, after+1, frame.sequence-1)
+      if missed is not None:
+        self.stats['recovered'] += protocol.count(missed)
+        self._dispatch(missed)
+
+  def _handle_message(self, raw):
+    """Decode ticker message and dispatch to handlers."""
+    frame = protocol.decode(raw)
+    if frame is None:
+      logger.warning("Malformed ticker message of %s bytes.", len(raw))
+      return
+    self.stats['messages'] += 1
+    if self.metrics:
+      self._tick_received = time.perf_counter_ns()
+    if frame.timestamp:
+      # End to end latency, assumes synchronised clocks
+      latency = (time.time_ns() - frame.timestamp)/1e9
+      self.stats['latency'] = latency
+      self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+    after = self._sequences.check(frame)
+    if after is not None:
+      self.stats['gaps'] = self._sequences.gaps
+      self.stats['missed'] = self._sequences.missed
+      logger.warning("Missed %s ticker records.", frame.sequence - after - 1)
+      if self._snapshot_socket is not None:
+        self._recover(frame, after)
+    self._dispatch(frame)
+
+  def _dispatch(self, frame):
+    """Dispatch records of a decoded frame to handlers."""
+    symbol = protocol.symbol_name(frame.symbol)
+    # A frame may carry many ticks or bars
+    if frame.type == protocol.TICK:
+      # Legacy tickers do not send times
+      timestamp = frame.timestamp or time.time_ns()
+      for bid, ask in protocol.unpack(frame):
+        if self._bars:
+          self._update_bars(frame.symbol, bid, timestamp)
+        self.on_symbol_tick(symbol, bid, ask)
+    elif frame.type == protocol.BAR:
+      for bo, bh, bl, bc in protocol.unpack(frame):
+        self.on_symbol_bar(symbol, bo, bh, bl, bc)
+
   def remote_run(self):
     """Start main loop and receive updates."""
     # Check connection
@@ -227,38 +567,110 @@ class Agent:
         if not socks:
           continue
         raw = socks[0][0].recv()
-        # unpack bytes https://docs.python.org/3/library/struct.html
-        if len(raw) == 17:
-          # We have tick data
-          bid, ask = struct.unpack_from('dd', raw, 1) # offset topic
-          self.on_tick(bid, ask)
-        elif len(raw) == 33:
-          # We have bar data
-          bo, bh, bl, bc = struct.unpack_from('dddd', raw, 1) # offset topic
-          self.on_bar(bo, bh, bl, bc)
+        self._handle_message(raw)
+        if self.metrics:
+          self._dump_metrics()
     finally:
       logger.info("Stopping agent...")
+      logger.info("Ticker stats: %s", self.stats)
+      if self.metrics:
+        logger.info("Latency metrics (us): %s", self.metrics.snapshot())
       self.disconnect()
 
-  def local_run(self):
-    """Run agaisnt local backtesting file."""
-    import csv
-    with open(self.backtest, newline='', encoding='utf-16') as csvfile:
-      reader = csv.reader(csvfile)
-      try:
-        for row in reader:
-          data = [float(x) for x in row[1:]]
-          if row[0] == 'tick':
-            self._last_tick = tuple(data)
-            self.on_tick(*data)
-          elif row[0] == 'bar':
-            self.on_bar(*data)
-      except KeyboardInterrupt:
-        pass # Nothing to do
-      finally:
-        print("--------------")
-        print("Final session balance:", self.balance)
-        print("--------------")
+  def _batch_run(self, data):
+    """Run array level hook against backtest data.
+    :return: true if the agent handled the whole series false otherwise
+    """
+    import numpy as np
+    from . import backtest
+    bids, asks = backtest.ticks(data)
+    signals = self.on_ticks(bids, asks)
+    if signals is None:
+      return False
+    times = data.time[np.asarray(data.kind) == backtest.TICK] if self.execution.latency_time else None
+    result = backtest.simulate(bids, asks, signals, execution=self.execution, times=times)
+    if len(result.equity):
+      equity = self.balance + result.equity
+      peak = np.maximum(np.maximum.accumulate(equity), self._peak)
+      self.drawdown = max(self.drawdown, float((peak - equity).max()))
+      self._peak = float(peak[-1])
+      self.balance = float(equity[-1])
+    self.trades += len(result.profits)
+    # Keep the final open order if any
+    if len(result.opens) > len(result.closes):
+      otype = "buy" if result.types[-1] == 1 else "sell"
+      order = Order(id=self._last_order_id+len(result.opens),
+                    price=float(result.open_prices[-1]),
+                    volume=self.execution.fill_volume(0.01), type=otype)
+      self.orders[order.id] = order
+    self._last_order_id += len(result.opens)
+    self._last_tick = (float(bids[-1]), float(asks[-1])) if len(bids) else self._last_tick
+    return True
+
+  def _replay_bars(self, data):
+    """Compute bars of all aggregators over backtest ticks in one pass each.
+    :return: sorted rows at which bars complete, (handler, bar) of each row
+    """
+    import numpy as np
+    from . import backtest, bars
+    if not self._bars:
+      return list(), list()
+    tickrows = np.flatnonzero(np.asarray(data.kind) == backtest.TICK)
+    bids = backtest.ticks(data)[0]
+    times = data.time[tickrows]
+    rows, events = list(), list()
+    for agg, handler, _ in self._bars:
+      out, ends = bars.resample(bids, agg.size, agg.kind, times=times)
+      rows.append(tickrows[ends])
+      events.extend((handler, bar) for bar in out.tolist())
+    rows = np.concatenate(rows)
+    order = np.argsort(rows, kind='stable')
+    return rows[order].tolist(), [events[i] for i in order.tolist()]
+
+  def _replay(self, data):
+    """Replay backtest data tick by tick."""
+    from .backtest import TICK, BAR
+    rows, events = self._replay_bars(data)
+    nextbar = 0 # Index of the next bar to complete
+    # Convert in chunks so memory mapped files are not loaded whole
+    for start in range(0, len(data.kind), self.replay_chunk):
+      end = start + self.replay_chunk
+      for idx, (kind, stamp, row) in enumerate(zip(data.kind[start:end].tolist(),
+                                                  data.time[start:end].tolist(),
+                                                  data.prices[start:end].tolist()), start):
+        if kind == TICK:
+          self._last_tick = (row[0], row[1])
+          self._tick_index += 1
+          self._tick_time = stamp
+          if self._queued:
+            self._fill_queued()
+          # Bars completed by this tick come before it as when live
+          # and orders placed by their handlers fill at its prices
+          while nextbar < len(rows) and rows[nextbar] == idx:
+            handler, bar = events[nextbar]
+            handler(*bar)
+            nextbar += 1
+          # Backtest files hold a single unnamed symbol
+          self.on_symbol_tick("", row[0], row[1])
+        elif kind == BAR:
+          self.on_symbol_bar("", *row)
+
+  def local_run(self, data=None):
+    """Run agaisnt local backtesting file.
+    :param data: already loaded backtest data if any
+    """
+    if data is None:
+      from . import backtest
+      data = backtest.load(self.backtest)
+    try:
+      if not self._batch_run(data):
+        self._replay(data)
+    except KeyboardInterrupt:
+      pass # Nothing to do
+    finally:
+      print("--------------")
+      print("Final session balance:", self.balance)
+      print("--------------")
 
   def run(self):
     """Run agent."""
@@ -0,0 +1,280 @@
+"""Asynchronous agent runtime using asyncio."""
+import asyncio
+import logging
+
+import aiohttp
+import zmq
+import zmq.asyncio
+
+from .agent import Agent, Order
+
+logger = logging.getLogger(__name__)
+
+# pylint: disable=broad-except
+
+# Context are thread safe already,
+# we'll create one global one for all agents
+context = zmq.asyncio.Context()
+
+
+class AsyncAgent(Agent):
+  """Trading agent that keeps handling ticks while orders are in flight.
+  Orders are sent asynchronously, buy, sell and close return awaitable
+  futures and on_order, on_order_close are called once they complete.
+  """
+  name = "asyncagent"
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self._socket = None # Ticker asyncio socket
+    self._pending = {"buy": 0, "sell": 0} # Orders in flight per type
+    self._closing = set() # Order ids being closed
+    self._tasks = set() # Outstanding order tasks
+    self._replies = dict() # Trading channel request id to response future
+    self._next_request = 0 # Trading channel request id counter
+    self._reader = None # Trading channel response reader task
+
+  async def aconnect(self):
+    """Attempt to connect pedlarweb and ticker endpoints."""
+    #-- pedlarweb connection
+    logger.info("Attempting to login to Pedlar web.")
+    payload = {'username': self.username, 'password': self.password}
+    try:
+      async with aiohttp.ClientSession() as session:
+        async with session.post(self.endpoint+"/api/token", json=payload) as r:
+          status = r.status
+          token = (await r.json())['token'] if status == 200 else None
+    except Exception:
+      logger.critical("Failed to connect to Pedlar web.")
+      raise RuntimeError("Connection to Pedlar web failed.")
+    if token is None:
+      raise Exception("Failed login into Pedlar web.")
+    self._token = token
+    self._session = aiohttp.ClientSession(raise_for_status=True,
+                                          headers={'Authorization': "Bearer " + token})
+    if self.transport == "zmq":
+      # Requests are multiplexed over a single DEALER socket
+      self._channel_socket = context.socket(zmq.DEALER)
+      self._channel_socket.setsockopt(zmq.LINGER, 0)
+      logger.info("Connecting to trading channel: %s", self.channel)
+      self._channel_socket.connect(self.channel)
+      self._reader = asyncio.ensure_future(self._channel_read())
+    logger.info("Pedlar web authentication successful.")
+    #-- ticker connection
+    self._socket = context.socket(zmq.SUB)
+    self._subscribe(self._socket)
+    logger.info("Connecting to ticker: %s", self.ticker)
+    self._socket.connect(self.ticker)
+    if self.snapshot:
+      # Recovery is rare and short so a blocking socket is used
+      self._snapshot_connect()
+
+  async def adisconnect(self):
+    """Close server connection gracefully in any."""
+    # Wait for orders in flight then clean up remaining ones
+    if self._tasks:
+      await asyncio.gather(*self._tasks, return_exceptions=True)
+    await self.close()
+    logger.info("Logging out of Pedlar web.")
+    try:
+      async with self._session.delete(self.endpoint+"/api/token") as r:
+        if r.status != 204:
+          logger.warning("Could not logout from Pedlar web.")
+    finally:
+      await self._session.close()
+      self._socket.close()
+      if self._reader is not None:
+        self._reader.cancel()
+        self._channel_socket.close()
+      if self._snapshot_socket is not None:
+        self._snapshot_socket.close()
+
+  async def _channel_read(self):
+    """Resolve pending requests as trading channel responses arrive."""
+    while True:
+      reqid, raw = await self._channel_socket.recv_multipart()
+      future = self._replies.pop(reqid, None)
+      if future is not None and not future.done():
+        future.set_result(raw)
+
+  async def _achannel_talk(self, requests):
+    """Send requests over the trading channel without blocking other orders.
+    :return: list of responses, failed ones have non-zero retcode
+    """
+    # The server echoes the request id frame back with the response
+    self._next_request += 1
+    reqid = str(self._next_request).encode()
+    future = asyncio.get_event_loop().create_future()
+    self._replies[reqid] = future
+    try:
+      await self._channel_socket.send_multipart([reqid] + self._channel_frames(requests))
+      raw = await asyncio.wait_for(future, self.channel_timeout/1000)
+    except (zmq.ZMQError, asyncio.TimeoutError) as e:
+      logger.error("Pedlar web communication error: %s", str(e) or "timeout")
+      raise IOError("Pedlar web server communication error.")
+    finally:
+      self._replies.pop(reqid, None)
+    return self._channel_responses(requests, raw)
+
+  async def atalk(self, order_id=0, volume=0.01, action=0):
+    """Make an asynchronous request response attempt to Pedlar web."""
+    payload = {'order_id': order_id, 'volume': volume, 'action': action,
+               'name': self.name}
+    if self.transport == "zmq":
+      resp = (await self._achannel_talk([payload]))[0]
+      if resp['retcode'] != 0:
+        logger.error("Pedlar web communication error: %s", resp['retcode'])
+        raise IOError("Pedlar web server communication error.")
+      return resp
+    try:
+      async with self._session.post(self.endpoint+'/api/trade', json=payload) as r:
+        resp = await r.json()
+    except Exception as e:
+      logger.error("Pedlar web communication error: %s", str(e))
+      raise IOError("Pedlar web server communication error.")
+    return resp
+
+  async def atalk_many(self, requests):
+    """Send many requests to Pedlar web in a single round trip."""
+    if self.transport == "zmq":
+      return await self._achannel_talk(requests)
+    payload = [dict({'order_id': 0, 'volume': 0.01, 'action': 0}, name=self.name, **r)
+               for r in requests]
+    try:
+      async with self._session.post(self.endpoint+'/api/trade', json=payload) as r:
+        resp = await r.json()
+    except Exception as e:
+      logger.error("Pedlar web communication error: %s", str(e))
+      raise IOError("Pedlar web server communication error.")
+    return resp
+
+  def _spawn(self, coro):
+    """Schedule order coroutine and keep track of it."""
+    task = asyncio.ensure_future(coro)
+    self._tasks.add(task)
+    task.add_done_callback(self._tasks.discard)
+    return task
+
+  @staticmethod
+  def _done(result):
+    """Return an already completed future."""
+    future = asyncio.get_event_loop().create_future()
+    future.set_result(result)
+    return future
+
+  def _place_order(self, otype="buy", volume=0.01, single=True, reverse=True):
+    """Schedule a buy or a sell order.
+    :return: future of the placed order or None
+    """
+    if self.backtest:
+      return super()._place_order(otype=otype, volume=volume, single=single, reverse=reverse)
+    # Check in flight orders as well to avoid duplicates
+    if single and (self._pending[otype] or
+                   [1 for o in self.orders.values() if o.type == otype]):
+      return self._done(None)
+    self._pending[otype] += 1
+    return self._spawn(self._aplace_order(otype, volume, reverse, self._decided()))
+
+  async def _aplace_order(self, otype, volume, reverse, decided=0):
+    """Place an order once opposite orders are closed."""
+    ootype = "sell" if otype == "buy" else "buy" # Opposite order type
+    try:
+      if (reverse and
+          not await self.close([oid for oid, o in self.orders.items() if o.type == ootype])):
+        return None
+      logger.info("Placing a %s order.", otype)
+      resp = await self.atalk(volume=volume, action=2 if otype == "buy" else 3)
+      order = Order(id=resp['order_id'], price=resp['price'], volume=volume, type=otype)
+      self._filled(decided)
+      self._last_order_id = order.id
+      self.orders[order.id] = order
+      self.on_order(order)
+      return order
+    except Exception as e:
+      logger.error("Failed to place %s order: %s", otype, str(e))
+      return None
+    finally:
+      self._pending[otype] -= 1
+
+  def buy(self, volume=0.01, single=True, reverse=True):
+    """Place a new buy order and store it in self.orders
+    :param volume: size of trade
+    :param single: only place if there is not an already
+    :param reverse: close sell orders if any
+    :return: future of the placed order
+    """
+    return self._place_order(otype="buy", volume=volume, single=single, reverse=reverse)
+
+  def sell(self, volume=0.01, single=True, reverse=True):
+    """Place a new sell order and store it in self.orders
+    :param volume: size of trade
+    :param single: only place if there is not an already
+    :param reverse: close buy orders if any
+    :return: future of the placed order
+    """
+    return self._place_order(otype="sell", volume=volume, single=single, reverse=reverse)
+
+  def close(self, order_ids=None):
+    """Close open all orders or given ids concurrently
+    :param order_ids: only close these orders
+    :return: future resolving true on success false otherwise
+    """
+    if self.backtest:
+      return super().close(order_ids)
+    oids = order_ids if order_ids is not None else list(self.orders.keys())
+    # Orders already being closed are awaited by their own request
+    oids = [oid for oid in oids if oid not in self._closing]
+    self._closing.update(oids)
+    return self._spawn(self._aclose(oids, self._decided() if oids else 0))
+
+  async def _aclose_batch(self, oids):
+    """Close a batch of orders in a single request."""
+    try:
+      if len(oids) == 1:
+        resps = [await self.atalk(order_id=oids[0], action=1)]
+      else:
+        resps = await self.atalk_many([{'order_id': oid, 'action': 1} for oid in oids])
+    except Exception as e:
+      logger.error("Failed to close orders %s: %s", oids, str(e))
+      return False
+    finally:
+      self._closing.difference_update(oids)
+    success = True
+    for oid, resp in zip(oids, resps):
+      if resp['retcode'] != 0:
+        logger.error("Failed to close order %s: %s", oid, resp['retcode'])
+        success = False
+        continue
+      self._closed(oid, resp)
+    return success
+
+  async def _aclose(self, oids, decided=0):
+    """Close given orders with concurrent batches."""
+    results = await asyncio.gather(*[self._aclose_batch(oids[i:i+self.batch_size])
+                                     for i in range(0, len(oids), self.batch_size)])
+    self._filled(decided)
+    return all(results)
+
+  async def _remote_run(self):
+    """Receive updates while orders are handled concurrently."""
+    if not self._session:
+      await self.aconnect()
+    logger.info("Starting main trading loop...")
+    try:
+      while True:
+        raw = await self._socket.recv()
+        self._handle_message(raw)
+        if self.metrics:
+          self._dump_metrics()
+    finally:
+      logger.info("Stopping agent...")
+      if self.metrics:
+        logger.info("Latency metrics (us): %s", self.metrics.snapshot())
+      await self.adisconnect()
+
+  def remote_run(self):
+    """Start asyncio event loop and receive updates."""
+    try:
+      asyncio.run(self._remote_run())
+    except KeyboardInterrupt:
+      pass # Disconnected on the way out
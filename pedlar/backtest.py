@@ -0,0 +1,208 @@
+"""Vectorised backtesting utilities."""
+import argparse
+from collections import namedtuple
+import csv
+import os
+import struct
+
+import numpy as np
+
+from .execution import LEVERAGE, Execution
+
+# Row kinds in a backtest file
+TICK, BAR = 0, 1
+# Trading signals returned from Agent.on_ticks
+HOLD, BUY, SELL, CLOSE = 0, 1, -1, 2
+
+# Binary tick store header: magic, version, flags, row count
+# followed by int64 time, uint8 kind and 4 float64 price columns
+MAGIC = b'PDLR'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQ')
+HEADER_SIZE = 64 # bytes, padded to keep columns aligned
+
+# Columnar backtest data, prices is N x 4 where
+# ticks use the first two columns as bid, ask
+# and bars use all four as open, high, low, close
+Data = namedtuple('Data', ['kind', 'time', 'prices'])
+# Outcome of a vectorised simulation
+# opens and closes are tick indices orders filled at, types are 1 buy, -1 sell
+# and open_prices the fill price of every open
+Result = namedtuple('Result', ['balance', 'profits', 'equity', 'opens', 'closes', 'position',
+                               'types', 'open_prices'])
+
+
+def load_csv(fname):
+  """Load a backtest CSV file into columnar arrays.
+  :param fname: UTF-16 file written by the MT5 ticker
+  :return: backtest Data
+  """
+  kinds, prices = list(), list()
+  nan = float('nan')
+  with open(fname, newline='', encoding='utf-16') as csvfile:
+    for row in csv.reader(csvfile):
+      if not row:
+        continue
+      data = [float(x) for x in row[1:]]
+      if row[0] == 'tick':
+        kinds.append(TICK)
+        prices.append(data[:2] + [nan, nan])
+      elif row[0] == 'bar':
+        kinds.append(BAR)
+        prices.append(data[:4])
+  kind = np.array(kinds, dtype=np.uint8)
+  prices = np.array(prices, dtype=np.float64).reshape(-1, 4)
+  return Data(kind=kind, time=np.zeros(len(kind), dtype=np.int64), prices=prices)
+
+def _offsets(rows):
+  """Byte offsets of time, kind and price columns."""
+  time = HEADER_SIZE
+  kind = time + 8*rows
+  prices = kind + (rows + 7)//8*8 # pad to 8 bytes
+  return time, kind, prices
+
+def save_bin(fname, data):
+  """Write backtest data to the binary tick store format."""
+  rows = len(data.kind)
+  if len(data.time) != rows or np.shape(data.prices) != (rows, 4):
+    raise ValueError("Backtest data columns have different lengths.")
+  _, koff, poff = _offsets(rows)
+  with open(fname, 'wb') as f:
+    f.write(HEADER.pack(MAGIC, VERSION, 0, rows).ljust(HEADER_SIZE, b'\0'))
+    np.ascontiguousarray(data.time, dtype='<i8').tofile(f)
+    np.ascontiguousarray(data.kind, dtype=np.uint8).tofile(f)
+    f.write(bytes(poff-koff-rows))
+    # Store prices column by column
+    np.ascontiguousarray(np.asarray(data.prices, dtype='<f8').T).tofile(f)
+    size = f.tell()
+  if size != poff + 32*rows:
+    # Do not leave a file that load would memory map
+    os.remove(fname)
+    raise IOError("Incomplete tick store written to: {}".format(fname))
+
+def load_bin(fname):
+  """Memory map a binary tick store without parsing it.
+  The returned arrays are read-only views backed by the page cache.
+  :param fname: file written by save_bin
+  :return: backtest Data
+  """
+  with open(fname, 'rb') as f:
+    magic, version, _, rows = HEADER.unpack(f.read(HEADER.size))
+  if magic != MAGIC or version != VERSION:
+    raise ValueError("Unsupported tick store: {}".format(fname))
+  toff, koff, poff = _offsets(rows)
+  if not rows:
+    return Data(kind=np.zeros(0, dtype=np.uint8), time=np.zeros(0, dtype=np.int64),
+                prices=np.zeros((0, 4)))
+  time = np.memmap(fname, dtype='<i8', mode='r', offset=toff, shape=(rows,))
+  kind = np.memmap(fname, dtype=np.uint8, mode='r', offset=koff, shape=(rows,))
+  prices = np.memmap(fname, dtype='<f8', mode='r', offset=poff, shape=(4, rows))
+  return Data(kind=kind, time=time, prices=prices.T)
+
+def is_bin(fname):
+  """Check if given file is a binary tick store."""
+  with open(fname, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+def load(fname):
+  """Load any supported backtest file or recorded symbol directory."""
+  if os.path.isdir(fname):
+    from . import recorder
+    return recorder.load(fname)
+  if is_bin(fname):
+    return load_bin(fname)
+  return load_csv(fname)
+
+def ticks(data):
+  """Extract bid and ask series of tick rows.
+  :return: bids, asks arrays
+  """
+  mask = data.kind == TICK
+  if mask.all():
+    # Avoid copying memory mapped columns
+    return data.prices[:, 0], data.prices[:, 1]
+  return data.prices[mask, 0], data.prices[mask, 1]
+
+def positions(signals):
+  """Compute the position held after each signal.
+  Buy and sell signals flip the position whereas close flattens it,
+  mirroring the default single and reverse order behaviour of Agent.
+  :param signals: array of HOLD, BUY, SELL, CLOSE
+  :return: array of 1 long, -1 short, 0 flat
+  """
+  sig = np.asarray(signals, dtype=np.int8)
+  # Prepend a flat sentinel so forward filling starts from no position
+  vals = np.concatenate(([0], np.where(sig == CLOSE, 0, sig)))
+  mask = np.concatenate(([True], sig != HOLD))
+  idx = np.where(mask, np.arange(len(vals)), 0)
+  np.maximum.accumulate(idx, out=idx)
+  return vals[idx][1:]
+
+def fills(index, execution, times=None):
+  """Tick indices at which orders placed at given ticks fill."""
+  index = np.asarray(index)
+  filled = index + execution.latency
+  if execution.latency_time and times is not None and len(times) and times[-1]:
+    # Files without tick times fill on latency ticks only
+    due = times[index] + int(execution.latency_time*1e9)
+    filled = np.maximum(filled, np.searchsorted(times, due))
+  return filled
+
+def simulate(bids, asks, signals, volume=0.01, leverage=LEVERAGE, execution=None, times=None):
+  """Simulate orders placed by signals over a tick series.
+  Fills follow Agent backtesting with the same execution model,
+  by default orders are placed and closed at the current tick.
+  :param bids: bid prices
+  :param asks: asking prices
+  :param signals: signal for every tick
+  :param volume: size of each trade
+  :param leverage: account leverage if no execution model is given
+  :param execution: pedlar.execution.Execution model
+  :param times: tick times in nanoseconds for time latencies
+  :return: simulation Result
+  """
+  execution = execution or Execution(leverage=leverage)
+  bids = np.asarray(bids, dtype=np.float64)
+  asks = np.asarray(asks, dtype=np.float64)
+  pos = positions(signals)
+  if pos.shape != bids.shape:
+    raise ValueError("Expected one signal per tick.")
+  prev = np.concatenate(([0], pos[:-1]))
+  change = np.flatnonzero(prev != pos)
+  otype = pos[change[pos[change] != 0]]
+  # Orders fill after the latency, those past the last tick never do
+  opens = fills(change[pos[change] != 0], execution, times)
+  closes = fills(change[prev[change] != 0], execution, times)
+  otype, opens = otype[opens < len(bids)], opens[opens < len(bids)]
+  closes = closes[closes < len(bids)]
+  volume = execution.fill_volume(volume)
+  buy = (otype == 1).astype(np.float64)
+  openp = execution.open_price(buy, bids[opens], asks[opens], volume)
+  # Every close pairs with the preceding open
+  paired = buy[:len(closes)]
+  closep = execution.close_price(paired, bids[closes], asks[closes], volume)
+  profits = execution.profit(paired, openp[:len(closes)], closep, volume)
+  # Python rounding to match the per tick path exactly,
+  # there are far fewer trades than ticks
+  profits = np.array([round(p, 2) for p in profits.tolist()], dtype=np.float64)
+  if execution.capital is not None and len(opens):
+    # Once an order is refused for margin the balance never changes
+    # so no later order can be placed either
+    before = np.concatenate(([0.0], np.cumsum(profits)))[:len(opens)]
+    refused = np.flatnonzero(~execution.allows(before, 0.0, volume))
+    if len(refused):
+      last = refused[0]
+      otype, opens, openp = otype[:last], opens[:last], openp[:last]
+      closes, profits = closes[:last], profits[:last]
+  equity = np.cumsum(profits)
+  balance = float(equity[-1]) if len(equity) else 0.0
+  return Result(balance=balance, profits=profits, equity=equity,
+                opens=opens, closes=closes, position=pos,
+                types=otype, open_prices=openp)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Convert backtest CSV to binary tick store.")
+  parser.add_argument("csvfile", help="UTF-16 CSV written by MT5 ticker.")
+  parser.add_argument("outfile", help="Binary tick store file to write.")
+  ARGS = parser.parse_args()
+  save_bin(ARGS.outfile, load_csv(ARGS.csvfile))
@@ -0,0 +1,128 @@
+"""Streaming and batch tick to bar aggregation.
+Streaming aggregators build open, high, low, close bars one tick at a time
+whereas resample computes the same completed bars over NumPy arrays.
+Times are nanoseconds since epoch as in the ticker protocol.
+"""
+import numpy as np
+
+# pylint: disable=too-few-public-methods
+
+
+class Bars:
+  """Base class for streaming bar aggregators.
+  Ticks are grouped into bars by an increasing bar id,
+  a bar completes when a tick of the next bar is seen.
+  """
+  def __init__(self, size):
+    if size <= 0:
+      raise ValueError("Bar size must be positive.")
+    self.size = size # Bar size in units of the aggregator
+    self.count = 0 # Number of completed bars
+    self._bar = None # Current [id, open, high, low, close]
+
+  def bar_id(self, time, volume):
+    """Bar id of the next tick."""
+    raise NotImplementedError
+
+  def complete(self, volume):
+    """Does the tick just added complete the current bar?"""
+    return False
+
+  def update(self, price, time=0, volume=1.0):
+    """Add new tick and return the bar it completes.
+    :return: (open, high, low, close) tuple or None
+    """
+    done = None
+    key = self.bar_id(time, volume)
+    bar = self._bar
+    if bar is not None and bar[0] != key:
+      # Tick belongs to the next bar
+      done = tuple(bar[1:])
+      bar = None
+    if bar is None:
+      self._bar = [key, price, price, price, price]
+    else:
+      bar[2] = max(bar[2], price)
+      bar[3] = min(bar[3], price)
+      bar[4] = price
+    if self.complete(volume):
+      done = tuple(self._bar[1:])
+      self._bar = None
+    if done is not None:
+      self.count += 1
+    return done
+
+
+class TimeBars(Bars):
+  """Bars over fixed time periods in seconds, aligned to the epoch."""
+  kind = "time"
+
+  def __init__(self, seconds):
+    super().__init__(seconds)
+    self._period = int(seconds*1e9)
+
+  def bar_id(self, time, volume):
+    """Period of the tick."""
+    return time // self._period
+
+
+class VolumeBars(Bars):
+  """Bars of a fixed traded volume, every tick counts as 1 if not given."""
+  kind = "volume"
+
+  def __init__(self, volume):
+    super().__init__(volume)
+    self._total = 0.0 # Volume so far
+
+  def bar_id(self, time, volume):
+    """Bars seen so far."""
+    return self._total // self.size
+
+  def complete(self, volume):
+    """Did the tick reach the next multiple of size?"""
+    before = self._total // self.size
+    self._total += volume
+    return self._total // self.size > before
+
+
+class TickBars(VolumeBars):
+  """Bars of a fixed number of ticks."""
+  kind = "tick"
+
+  def update(self, price, time=0, volume=1.0):
+    """Add new tick and return the bar it completes."""
+    return super().update(price, time)
+
+#-- batch form
+def resample(prices, size, kind="time", times=None, volumes=None):
+  """Completed bars of a tick series in one pass.
+  Gives the same bars as the streaming aggregators, the last
+  time bar is never complete since no later tick is seen.
+  :param prices: tick prices
+  :param size: seconds, ticks or volume per bar
+  :param kind: time, tick or volume
+  :param times: tick times in nanoseconds for time bars
+  :param volumes: tick volumes for volume bars, 1 per tick if None
+  :return: N x 4 array of open, high, low, close and
+           array of tick indices at which each bar completes
+  """
+  prices = np.asarray(prices, dtype=np.float64)
+  n = len(prices)
+  if kind == "time":
+    ids = np.asarray(times, dtype=np.int64) // int(size*1e9)
+  else:
+    vol = np.ones(n) if kind == "tick" or volumes is None else np.asarray(volumes, dtype=np.float64)
+    total = np.cumsum(vol)
+    ids = (total - vol) // size
+  if not n:
+    return np.zeros((0, 4)), np.zeros(0, dtype=np.int64)
+  starts = np.concatenate(([0], np.flatnonzero(ids[1:] != ids[:-1]) + 1))
+  ends = np.concatenate((starts[1:] - 1, [n - 1]))
+  bars = np.column_stack((prices[starts], np.maximum.reduceat(prices, starts),
+                          np.minimum.reduceat(prices, starts), prices[ends]))
+  if kind == "time":
+    # Completed by the first tick of the next bar
+    return bars[:-1], starts[1:]
+  # Completed by the tick crossing the next multiple of size
+  done = total[ends] // size > ids[ends]
+  return bars[done], ends[done]
@@ -1,8 +1,8 @@
 """Basic agent."""
 import argparse
-from collections import deque
 
 from .agent import Agent
+from .indicators import Mean
 
 
 class BasicAgent(Agent):
@@ -10,7 +10,7 @@ class BasicAgent(Agent):
   name = "alice"
   def __init__(self, histsize=40, **kwargs):
     self.histsize = histsize
-    self.past_ticks = deque(maxlen=histsize)
+    self.past_mean = Mean(histsize)
     self.period = 0
     self.past_avg = 0
     super().__init__(**kwargs) # Must call this
@@ -25,9 +25,9 @@ class BasicAgent(Agent):
 
   def on_tick(self, bid, ask):
     """On tick handler."""
-    self.past_ticks.append(bid)
+    avg = self.past_mean.update(bid)
     # Fill the buffer
-    if len(self.past_ticks) != self.histsize:
+    if not self.past_mean.ready:
       return
     # Let's wait period many ticks
     if self.period < self.histsize:
@@ -35,7 +35,6 @@ class BasicAgent(Agent):
       return
     # Compute average differences to see if price
     # going up or down and buy or sell
-    avg = sum(self.past_ticks)/self.histsize
     if avg - self.past_avg > 0:
       self.buy()
     else:
@@ -0,0 +1,98 @@
+"""Execution models of backtest orders.
+Prices are computed with plain arithmetic so the same methods work on
+floats for tick by tick replays and on NumPy arrays for vectorised
+simulations, buy is 1 for buy orders and 0 for sell orders.
+"""
+import ast
+
+LEVERAGE = 100 # Account leverage of the local broker and backtests
+LOT = 1000 # Base currency units of a volume of 1 in the profit formula
+
+
+def profit(diff, closep, volume, leverage=LEVERAGE):
+  """Profit of an order in account currency, same as the broker.
+  Assumes the account currency is the base currency of the symbol.
+  :param diff: favourable price difference between close and open
+  """
+  return diff*leverage*volume*LOT*(1/closep)
+
+
+class Execution:
+  """Fill model of backtest orders.
+  The defaults reproduce the original backtests, orders fill instantly
+  at the current tick with buys opening on bid and sells on ask.
+  """
+  def __init__(self, leverage=LEVERAGE, cross_spread=False, spread=0.0,
+               slippage=0.0, impact=0.0, commission=0.0, latency=0,
+               latency_time=0.0, liquidity=None, capital=None):
+    self.leverage = leverage # Account leverage
+    self.cross_spread = cross_spread # Buys open on ask and sells on bid like the broker
+    self.spread = spread # Extra spread in price added around bid and ask
+    self.slippage = slippage # Adverse price movement of every fill
+    self.impact = impact # Adverse price movement per unit of volume filled
+    self.commission = commission # Charged per unit of volume when an order closes
+    self.latency = latency # Ticks between an order decision and its fill
+    self.latency_time = latency_time # Seconds between an order decision and its fill
+    self.liquidity = liquidity # Maximum volume of a single fill, the rest is cancelled
+    self.capital = capital # Starting capital for margin checks, unlimited if None
+
+  @classmethod
+  def from_specs(cls, specs):
+    """Create from name=value strings, ex. latency=2 cross_spread=True"""
+    params = dict()
+    for spec in specs:
+      name, _, value = spec.partition('=')
+      params[name] = ast.literal_eval(value)
+    return cls(**params)
+
+  @property
+  def delayed(self):
+    """Do orders fill after the tick they are placed on?"""
+    return bool(self.latency or self.latency_time)
+
+  def due(self, index, time):
+    """Tick index and time in nanoseconds at which an order placed now fills.
+    An order fills on the first tick satisfying both.
+    """
+    return index + self.latency, time + int(self.latency_time*1e9)
+
+  def adverse(self, volume):
+    """Price movement against a fill of given volume."""
+    return self.spread/2 + self.slippage + self.impact*volume
+
+  def open_price(self, buy, bid, ask, volume):
+    """Price an order opens at."""
+    sign = 2*buy - 1
+    if self.cross_spread:
+      base = bid + buy*(ask - bid)
+    else:
+      base = ask + buy*(bid - ask)
+    return base + sign*self.adverse(volume)
+
+  def close_price(self, buy, bid, ask, volume):
+    """Price an order closes at, buys close on bid and sells on ask."""
+    sign = 2*buy - 1
+    return ask + buy*(bid - ask) - sign*self.adverse(volume)
+
+  def profit(self, buy, openp, closep, volume):
+    """Profit of closing an order after commission."""
+    diff = (2*buy - 1)*(closep - openp)
+    return profit(diff, closep, volume, self.leverage) - self.commission*volume
+
+  def fill_volume(self, volume):
+    """Volume filled of an order, partial if liquidity is limited."""
+    if self.liquidity is None:
+      return volume
+    return min(volume, self.liquidity)
+
+  @staticmethod
+  def margin(volume):
+    """Margin held by an open order in account currency."""
+    return volume*LOT
+
+  def allows(self, balance, used, volume):
+    """Is there enough free margin to open an order?
+    :param balance: realised profit so far
+    :param used: margin held by open orders
+    """
+    return self.capital is None or used + self.margin(volume) <= self.capital + balance
@@ -0,0 +1,151 @@
+"""Run many trading agents in one process over shared connections.
+The host subscribes to the ticker once for the symbols of all agents,
+decodes every message once and dispatches it to each agent. Agents
+trade on the account of the host over its HTTP session or trading
+channel, their orders are tagged with their own names and each keeps
+its own orders and balance. Only synchronous Agent subclasses are run.
+"""
+import argparse
+import ast
+import logging
+import multiprocessing
+import time
+
+from . import protocol
+from .agent import Agent
+from .sweep import load_class
+
+logger = logging.getLogger(__name__)
+
+
+class Host(Agent):
+  """Agent that dispatches ticker updates to many agents."""
+  name = "host"
+
+  def __init__(self, agents, **kwargs):
+    self.agents = list(agents) # Hosted agents in dispatch order
+    symbols = set()
+    for agent in self.agents:
+      if not agent.symbols:
+        # Someone wants everything
+        symbols = set()
+        break
+      symbols.update(agent.symbols)
+    kwargs['symbols'] = sorted(symbols)
+    super().__init__(**kwargs)
+    self._routes = dict() # Symbol id to agents receiving its updates
+    # Symbol ids of every agent, names are unknown to symbol_name
+    # for ids never passed to symbol_id as when subscribed to all
+    self._sids = [{protocol.symbol_id(s) for s in agent.symbols} for agent in self.agents]
+    for agent in self.agents:
+      agent.backtest = self.backtest
+
+  def _route(self, symbol):
+    """Agents following a symbol id."""
+    agents = self._routes.get(symbol)
+    if agents is None:
+      agents = self._routes[symbol] = [a for a, sids in zip(self.agents, self._sids)
+                                       if not sids or symbol in sids]
+    return agents
+
+  def connect(self):
+    """Login once and share connections with all agents."""
+    super().connect()
+    for agent in self.agents:
+      agent.endpoint, agent.transport, agent.channel = self.endpoint, self.transport, self.channel
+      agent._session = self._session # pylint: disable=protected-access
+      agent._token = self._token # pylint: disable=protected-access
+      agent._channel_socket = self._channel_socket # pylint: disable=protected-access
+    logger.info("Hosting %s agents.", len(self.agents))
+
+  def disconnect(self):
+    """Close orders of every agent then shared connections."""
+    for agent in self.agents:
+      try:
+        agent.close()
+      except Exception: # pylint: disable=broad-except
+        logger.exception("Agent %s failed to close its orders.", agent.name)
+      agent._session = agent._channel_socket = None # pylint: disable=protected-access
+      logger.info("Agent %s balance: %s", agent.name, agent.balance)
+    super().disconnect()
+
+  def _dispatch(self, frame):
+    """Dispatch a decoded frame to every agent following its symbol."""
+    received = self._tick_received or time.perf_counter_ns()
+    for agent in self._route(frame.symbol):
+      if agent.metrics:
+        agent._tick_received = received # pylint: disable=protected-access
+      try:
+        agent._dispatch(frame) # pylint: disable=protected-access
+      except Exception: # pylint: disable=broad-except
+        # One failing strategy should not stop the others
+        logger.exception("Agent %s failed to handle update.", agent.name)
+
+  def local_run(self, data=None):
+    """Backtest every agent against the same file loaded once."""
+    if data is None:
+      from . import backtest
+      data = backtest.load(self.backtest)
+    for agent in self.agents:
+      print("Agent:", agent.name)
+      agent.local_run(data=data)
+
+
+def load_agents(specs):
+  """Create agents from class[:name=value...] specifications.
+  Agents with the same name are numbered to keep their orders apart.
+  """
+  agents = list()
+  for spec in specs:
+    path, *params = spec.split(':')
+    params = {k: ast.literal_eval(v) for k, _, v in (p.partition('=') for p in params)}
+    name = params.pop('name', None)
+    agent = load_class(path)(**params)
+    agent.name = name or agent.name
+    agents.append(agent)
+  names = [a.name for a in agents]
+  for i, agent in enumerate(agents):
+    if names.count(agent.name) > 1:
+      agent.name = "{}-{}".format(agent.name, i)
+  return agents
+
+def _run_shard(specs, kwargs):
+  """Host a shard of agents in a worker process."""
+  logging.basicConfig(level=logging.INFO)
+  try:
+    Host(load_agents(specs), **kwargs).run()
+  except KeyboardInterrupt:
+    pass # Disconnected on the way out
+
+def run(specs, workers=1, **kwargs):
+  """Host agents, sharded round robin across worker processes if more than 1."""
+  if workers <= 1:
+    _run_shard(specs, kwargs)
+    return
+  procs = [multiprocessing.Process(target=_run_shard, args=(specs[i::workers], kwargs))
+           for i in range(min(workers, len(specs)))]
+  for proc in procs:
+    proc.start()
+  try:
+    for proc in procs:
+      proc.join()
+  except KeyboardInterrupt:
+    # Workers receive the interrupt as well and close their orders
+    for proc in procs:
+      proc.join()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, fromfile_prefix_chars='@')
+  parser.add_argument("agents", nargs='+',
+                      help="Agent classes with parameters, ex. pedlar.basic.BasicAgent:histsize=20")
+  parser.add_argument("-b", "--backtest", help="Backtest agaisnt given file.")
+  parser.add_argument("-u", "--username", default="nobody", help="Pedlar Web username.")
+  parser.add_argument("-p", "--password", default="", help="Pedlar Web password.")
+  parser.add_argument("-t", "--ticker", default="tcp://localhost:7000", help="Ticker endpoint.")
+  parser.add_argument("-e", "--endpoint", default="http://localhost:5000", help="Pedlar Web endpoint.")
+  parser.add_argument("--transport", default="http", choices=["http", "zmq"], help="Trade request transport.")
+  parser.add_argument("-c", "--channel", default="tcp://localhost:7200", help="Pedlar Web trading channel endpoint.")
+  parser.add_argument("-s", "--snapshot", help="Ticker snapshot endpoint to recover missed ticks.")
+  parser.add_argument("-j", "--workers", default=1, type=int, help="Number of worker processes.")
+  ARGS = vars(parser.parse_args())
+  run(ARGS.pop('agents'), **ARGS)
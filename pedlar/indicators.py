@@ -0,0 +1,243 @@
+"""Streaming and batch technical indicators.
+Streaming indicators update in constant time per tick using ring buffers
+whereas the batch functions compute the same values over NumPy arrays.
+Values are nan until enough data is seen to fill the window.
+"""
+from collections import deque
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# pylint: disable=too-few-public-methods
+
+NAN = float('nan')
+
+
+class Indicator:
+  """Base class for streaming indicators."""
+  def __init__(self, size):
+    if size < 1:
+      raise ValueError("Indicator size must be positive.")
+    self.size = size # Window size
+    self.count = 0 # Number of updates so far
+    self.value = NAN # Latest value
+
+  @property
+  def ready(self):
+    """Has the window been filled?"""
+    return self.count >= self.size
+
+  def update(self, x):
+    """Add new value and return the latest indicator value."""
+    raise NotImplementedError
+
+
+class Mean(Indicator):
+  """Rolling mean over a ring buffer."""
+  def __init__(self, size):
+    super().__init__(size)
+    self._buf = [0.0]*size
+    self._sum = 0.0
+    self._comp = 0.0 # Neumaier compensation to avoid drift
+
+  def _add(self, x):
+    """Compensated add to the running sum."""
+    t = self._sum + x
+    if abs(self._sum) >= abs(x):
+      self._comp += (self._sum - t) + x
+    else:
+      self._comp += (x - t) + self._sum
+    self._sum = t
+
+  def update(self, x):
+    """Add new value and return rolling mean."""
+    i = self.count % self.size
+    if self.count >= self.size:
+      self._add(-self._buf[i])
+    self._buf[i] = x
+    self._add(x)
+    self.count += 1
+    if self.ready:
+      self.value = (self._sum + self._comp)/self.size
+    return self.value
+
+
+class EMA(Indicator):
+  """Exponential moving average, alpha defaults to 2/(size+1)."""
+  def __init__(self, size, alpha=None):
+    super().__init__(size)
+    self.alpha = alpha or 2/(size+1)
+
+  @property
+  def ready(self):
+    """Has the average seen a value?"""
+    return self.count > 0
+
+  def update(self, x):
+    """Add new value and return the average."""
+    if self.count:
+      self.value += self.alpha*(x - self.value)
+    else:
+      self.value = x
+    self.count += 1
+    return self.value
+
+
+class Min(Indicator):
+  """Rolling minimum using a monotonic deque."""
+  sign = 1
+
+  def __init__(self, size):
+    super().__init__(size)
+    self._deque = deque() # (index, signed value) increasing values
+
+  def update(self, x):
+    """Add new value and return rolling extremum."""
+    v = self.sign*x
+    while self._deque and self._deque[-1][1] >= v:
+      self._deque.pop()
+    self._deque.append((self.count, v))
+    if self._deque[0][0] <= self.count - self.size:
+      self._deque.popleft()
+    self.count += 1
+    if self.ready:
+      self.value = self.sign*self._deque[0][1]
+    return self.value
+
+
+class Max(Min):
+  """Rolling maximum using a monotonic deque."""
+  sign = -1
+
+
+class Variance(Indicator):
+  """Rolling variance using windowed Welford updates."""
+  def __init__(self, size, ddof=0):
+    super().__init__(size)
+    if size <= ddof:
+      raise ValueError("Variance size must be greater than ddof.")
+    self.ddof = ddof
+    self._buf = [0.0]*size
+    self._mean = 0.0
+    self._m2 = 0.0
+
+  def update(self, x):
+    """Add new value and return rolling variance."""
+    i = self.count % self.size
+    if self.count < self.size:
+      # Grow the window
+      delta = x - self._mean
+      self._mean += delta/(self.count+1)
+      self._m2 += delta*(x - self._mean)
+    else:
+      # Replace oldest value
+      old = self._buf[i]
+      new_mean = self._mean + (x - old)/self.size
+      self._m2 += (x - old)*(x - new_mean + old - self._mean)
+      self._mean = new_mean
+    self._buf[i] = x
+    self.count += 1
+    if self.ready:
+      self.value = max(self._m2, 0.0)/(self.size - self.ddof)
+    return self.value
+
+
+class VWAP(Indicator):
+  """Volume weighted average price, cumulative if size is None."""
+  def __init__(self, size=None):
+    super().__init__(size or 1)
+    self.window = size
+    self._pv = Mean(size) if size else None
+    self._v = Mean(size) if size else None
+    self._cumpv = 0.0
+    self._cumv = 0.0
+
+  def update(self, price, volume=1.0):
+    """Add new trade and return average price."""
+    self.count += 1
+    if self.window:
+      pv, v = self._pv.update(price*volume), self._v.update(volume)
+    else:
+      self._cumpv += price*volume
+      self._cumv += volume
+      pv, v = self._cumpv, self._cumv
+    if self.ready and v:
+      self.value = pv/v
+    return self.value
+
+#-- batch forms
+def mean(x, size):
+  """Rolling mean of array."""
+  x = np.asarray(x, dtype=np.float64)
+  out = np.full(len(x), NAN)
+  if len(x) < size:
+    return out
+  # Centre values to reduce cumulative rounding error
+  c = np.cumsum(x - x[0])
+  c = np.concatenate(([0.0], c))
+  out[size-1:] = (c[size:] - c[:-size])/size + x[0]
+  return out
+
+def ema(x, size, alpha=None):
+  """Exponential moving average of array, computed in blocks."""
+  x = np.asarray(x, dtype=np.float64)
+  alpha = alpha or 2/(size+1)
+  decay = 1 - alpha
+  if not len(x) or decay <= 0:
+    return x.copy()
+  # y_i = decay^(i+1) (y_prev + sum_j alpha x_j decay^-(j+1))
+  # blocks keep the decay powers within float range
+  block = max(1, int(200/-math.log10(decay)))
+  out = np.empty(len(x))
+  prev = x[0]
+  for start in range(0, len(x), block):
+    xb = x[start:start+block]
+    powers = decay**np.arange(1, len(xb)+1)
+    out[start:start+len(xb)] = powers*(prev + np.cumsum(alpha*xb/powers))
+    prev = out[start+len(xb)-1]
+  return out
+
+def _rolling_extremum(x, size, func):
+  """Van Herk/Gil-Werman rolling extremum in linear time."""
+  x = np.asarray(x, dtype=np.float64)
+  n = len(x)
+  out = np.full(n, NAN)
+  if n < size:
+    return out
+  pad = (-n) % size
+  fill = np.inf if func is np.minimum else -np.inf
+  xp = np.concatenate((x, np.full(pad, fill))).reshape(-1, size)
+  prefix = func.accumulate(xp, axis=1).ravel()
+  suffix = func.accumulate(xp[:, ::-1], axis=1)[:, ::-1].ravel()
+  out[size-1:] = func(suffix[:n-size+1], prefix[size-1:n])
+  return out
+
+def rolling_min(x, size):
+  """Rolling minimum of array."""
+  return _rolling_extremum(x, size, np.minimum)
+
+def rolling_max(x, size):
+  """Rolling maximum of array."""
+  return _rolling_extremum(x, size, np.maximum)
+
+def variance(x, size, ddof=0, chunk=65536):
+  """Rolling variance of array, computed in chunks to bound memory."""
+  x = np.asarray(x, dtype=np.float64)
+  out = np.full(len(x), NAN)
+  if len(x) < size:
+    return out
+  windows = sliding_window_view(x, size)
+  for start in range(0, len(windows), chunk):
+    out[size-1+start:size-1+start+chunk] = windows[start:start+chunk].var(axis=1, ddof=ddof)
+  return out
+
+def vwap(prices, volumes=None, size=None):
+  """Volume weighted average price, cumulative if size is None."""
+  prices = np.asarray(prices, dtype=np.float64)
+  volumes = np.ones(len(prices)) if volumes is None else np.asarray(volumes, dtype=np.float64)
+  if size is None:
+    with np.errstate(invalid='ignore', divide='ignore'):
+      return np.cumsum(prices*volumes)/np.cumsum(volumes)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    return mean(prices*volumes, size)/mean(volumes, size)
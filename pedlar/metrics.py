@@ -0,0 +1,100 @@
+"""Low overhead latency histograms.
+Values are nanoseconds from time.perf_counter_ns recorded into log-linear
+buckets, every power of two is split into equal sub-buckets so that
+percentiles are within a few percent like HDR histograms.
+"""
+import time
+
+SUB_BITS = 6 # 32 sub-buckets per power of two, about 3% precision
+HALF = 1 << (SUB_BITS - 1)
+
+
+class Histogram:
+  """Log-linear histogram of non-negative integer values."""
+  def __init__(self):
+    self._counts, self.count, self.total, self.max = self._empty()
+
+  @staticmethod
+  def _empty():
+    """Bucket counts, count, total and max of an empty histogram."""
+    return [0]*(HALF*(64 - SUB_BITS + 2)), 0, 0, 0
+
+  @staticmethod
+  def index(value):
+    """Bucket index of a value."""
+    shift = value.bit_length() - SUB_BITS
+    if shift <= 0:
+      return value
+    return HALF*shift + (value >> shift)
+
+  @staticmethod
+  def lowest(index):
+    """Lowest value of a bucket."""
+    if index < 2*HALF:
+      return index
+    shift = index//HALF - 1
+    return (index - HALF*shift) << shift
+
+  def record(self, value):
+    """Add a single value."""
+    value = max(value, 0)
+    self._counts[self.index(value)] += 1
+    self.count += 1
+    self.total += value
+    if value > self.max:
+      self.max = value
+
+  def percentile(self, q):
+    """Value below which q percent of recorded values are, 0 if empty."""
+    target = self.count*q/100
+    seen = 0
+    for idx, c in enumerate(self._counts):
+      seen += c
+      if c and seen >= target:
+        return min(self.lowest(idx+1) - 1, self.max)
+    return 0
+
+  def reset(self):
+    """Remove all values."""
+    self._counts, self.count, self.total, self.max = self._empty()
+
+  def snapshot(self):
+    """Summary in microseconds."""
+    return {'count': self.count,
+            'mean': round(self.total/self.count/1e3, 1) if self.count else 0.0,
+            'p50': round(self.percentile(50)/1e3, 1),
+            'p90': round(self.percentile(90)/1e3, 1),
+            'p99': round(self.percentile(99)/1e3, 1),
+            'max': round(self.max/1e3, 1)}
+
+
+class Metrics:
+  """Named latency histograms, nothing is timed or recorded when disabled."""
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    self.histograms = dict() # Name to Histogram
+
+  def start(self):
+    """Timestamp to pass to stop, 0 when disabled."""
+    return time.perf_counter_ns() if self.enabled else 0
+
+  def stop(self, name, start):
+    """Record time elapsed since start under name."""
+    if start:
+      self.record(name, time.perf_counter_ns() - start)
+
+  def record(self, name, value):
+    """Record a value in nanoseconds under name."""
+    hist = self.histograms.get(name)
+    if hist is None:
+      hist = self.histograms[name] = Histogram()
+    hist.record(value)
+
+  def snapshot(self):
+    """Summaries of all histograms in microseconds."""
+    return {name: hist.snapshot() for name, hist in self.histograms.items()}
+
+  def reset(self):
+    """Remove recorded values of all histograms."""
+    for hist in self.histograms.values():
+      hist.reset()
@@ -0,0 +1,161 @@
+"""Binary wire protocol of ticker and broker messages."""
+from collections import namedtuple
+import struct
+import time
+
+# Message types, the first byte of every ticker message
+# so that subscribers can filter on it as a topic
+TICK, BAR = 0, 1
+VERSION = 1
+
+# Ticker header: uchar type, uchar version, ushort symbol id,
+# ushort record count, 2 padding bytes, ulong sequence of the
+# first record and ulong timestamp in nanoseconds since epoch
+HEADER = struct.Struct('<BBHH2xQQ')
+# Records following the header back to back
+RECORDS = {TICK: struct.Struct('<dd'), # bid, ask
+           BAR: struct.Struct('<dddd')} # open, high, low, close
+
+# Unversioned messages sent by older tickers, a topic
+# byte followed by a single record, never a valid frame size
+LEGACY_SIZES = {1 + r.size: t for t, r in RECORDS.items()}
+
+# Broker messages keep the fixed layout of the MT5 broker
+# packed back to back in a single message
+# Request: ulong order_id, double volume, uchar action
+REQUEST = struct.Struct('<QdB')
+# Response: ulong order_id, double price, double profit, uint retcode
+RESPONSE = struct.Struct('<QddI')
+# Most requests in a single broker message, MAX_BATCH of broker.mq5
+# must match as it rejects larger messages without trading
+MAX_BATCH = 32
+
+# Snapshot request: topic of a type and symbol followed by
+# ulong last sequence seen, replies are the stored messages after it
+SNAPSHOT = struct.Struct('<4sQ')
+
+# Decoded ticker message, records is a memoryview
+# into the received message to avoid copying
+Frame = namedtuple('Frame', ['type', 'symbol', 'sequence', 'timestamp', 'records'])
+
+# Symbol names seen by symbol_id, 0 is the unnamed symbol of legacy tickers
+_NAMES = {0: ""}
+
+
+def symbol_id(name):
+  """Symbol id of a symbol name such as EURUSD.
+  Ids are 32 bit FNV-1a hashes of the name folded into 16 bits
+  so that publishers need no shared symbol table, see libzmq.mqh.
+  """
+  h = 2166136261
+  for c in name.encode('ascii'):
+    h = ((h ^ c)*16777619) & 0xFFFFFFFF
+  sid = (h >> 16) ^ (h & 0xFFFF) or 1
+  _NAMES.setdefault(sid, name)
+  return sid
+
+def symbol_name(sid):
+  """Symbol name of an id seen before, the id as string otherwise."""
+  return _NAMES.get(sid, str(sid))
+
+def topic(mtype, symbol=None):
+  """Subscription prefix of a message type for all or a single symbol id."""
+  if symbol is None:
+    return bytes([mtype])
+  return HEADER.pack(mtype, VERSION, symbol, 0, 0, 0)[:4]
+
+
+def encode(mtype, records, symbol=0, sequence=0, timestamp=None):
+  """Encode many records of the same type into a single frame.
+  :param records: sequence of record tuples
+  :param sequence: sequence number of the first record
+  :param timestamp: nanoseconds since epoch, now if None
+  :return: bytes of the frame
+  """
+  timestamp = time.time_ns() if timestamp is None else timestamp
+  record = RECORDS[mtype]
+  return b''.join([HEADER.pack(mtype, VERSION, symbol, len(records), sequence, timestamp)] +
+                  [record.pack(*r) for r in records])
+
+def decode(raw):
+  """Decode a ticker message header without copying records.
+  Legacy messages are reported with symbol, sequence and timestamp 0.
+  :return: Frame or None if the message is malformed
+  """
+  view = memoryview(raw)
+  mtype = LEGACY_SIZES.get(len(view))
+  if mtype is not None:
+    return Frame(mtype, 0, 0, 0, view[1:])
+  if len(view) < HEADER.size:
+    return None
+  mtype, version, symbol, nrecords, sequence, timestamp = HEADER.unpack_from(view)
+  record = RECORDS.get(mtype)
+  if (version != VERSION or record is None or not nrecords or
+      len(view) != HEADER.size + nrecords*record.size):
+    return None
+  return Frame(mtype, symbol, sequence, timestamp, view[HEADER.size:])
+
+def count(frame):
+  """Number of records in a decoded frame."""
+  return len(frame.records) // RECORDS[frame.type].size
+
+def between(frame, first_seq, last_seq):
+  """Restrict a sequenced frame to records with sequence in [first_seq, last_seq].
+  :return: Frame or None if no records are left
+  """
+  size = RECORDS[frame.type].size
+  start = max(first_seq - frame.sequence, 0)
+  end = min(last_seq - frame.sequence + 1, count(frame))
+  if start >= end:
+    return None
+  return frame._replace(sequence=frame.sequence+start, records=frame.records[start*size:end*size])
+
+def unpack(frame):
+  """Iterate over record tuples of a decoded frame."""
+  return RECORDS[frame.type].iter_unpack(frame.records)
+
+def last(frame):
+  """Return the last record tuple of a decoded frame."""
+  record = RECORDS[frame.type]
+  return record.unpack_from(frame.records, len(frame.records) - record.size)
+
+class Sequences:
+  """Detect missed records of sequenced frames per message type and symbol.
+  A sequence going backwards is taken as a restarted publisher.
+  """
+  def __init__(self):
+    self._last = dict() # (type, symbol) to last sequence seen
+    self.gaps = 0 # Number of gaps
+    self.missed = 0 # Number of records missed in gaps
+    self.resets = 0 # Number of publisher restarts
+
+  def check(self, frame):
+    """Record a frame and report a gap before it.
+    :return: last sequence seen before the gap, None if there is no gap
+    """
+    if not frame.sequence:
+      # Legacy frames are not sequenced
+      return None
+    key = (frame.type, frame.symbol)
+    prev = self._last.get(key)
+    self._last[key] = frame.sequence + count(frame) - 1
+    if prev is None:
+      return None
+    if frame.sequence <= prev:
+      self.resets += 1
+      return None
+    if frame.sequence > prev + 1:
+      self.gaps += 1
+      self.missed += frame.sequence - prev - 1
+      return prev
+    return None
+
+def pack_requests(requests):
+  """Pack broker request dictionaries back to back."""
+  return b''.join([REQUEST.pack(r.get('order_id', 0), r.get('volume', 0.01), r.get('action', 0))
+                   for r in requests])
+
+def unpack_responses(raw):
+  """Unpack broker responses into dictionaries."""
+  return [{'order_id': order_id, 'price': price, 'profit': profit, 'retcode': retcode}
+          for order_id, price, profit, retcode in RESPONSE.iter_unpack(raw)]
@@ -0,0 +1,270 @@
+"""Record the ticker stream into rolling compressed archives.
+Every symbol is written to its own directory of time partitioned files,
+each file is a sequence of independently compressed chunks with a sidecar
+index of chunk time ranges so that any period is read back by
+decompressing only the chunks overlapping it.
+Directories are named after symbols, ticker messages only carry symbol
+ids so names must be known in advance. Symbols recorded without being
+given as symbols or names are written to directories named after their
+numeric ids.
+"""
+import argparse
+import datetime
+import logging
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+import zmq
+
+from . import backtest, protocol
+
+logger = logging.getLogger(__name__)
+
+# Chunk header: magic, row count, compressed size and
+# first, last row time in nanoseconds followed by the compressed
+# int64 time offsets from first, uint8 kinds and 4 float64 price columns
+CHUNK_MAGIC = b'PDLC'
+CHUNK = struct.Struct('<4sIIqq')
+# Index record: first, last row time, chunk offset and row count
+INDEX = struct.Struct('<qqQI4x')
+INDEX_DTYPE = np.dtype([('first', '<i8'), ('last', '<i8'), ('offset', '<u8'),
+                        ('rows', '<u4'), ('pad', 'V4')])
+SUFFIX = ".pdc" # Partition file name suffix, the index adds .idx
+NAME_FORMAT = "%Y%m%d-%H%M%S" # UTC start time of a partition
+
+
+def _partition_name(start):
+  """File name of the partition starting at start nanoseconds."""
+  stamp = datetime.datetime.fromtimestamp(start // 10**9, datetime.timezone.utc)
+  return stamp.strftime(NAME_FORMAT) + SUFFIX
+
+def _partition_start(fname):
+  """Start time in nanoseconds of a partition file name."""
+  stamp = datetime.datetime.strptime(os.path.basename(fname)[:-len(SUFFIX)], NAME_FORMAT)
+  return int(stamp.replace(tzinfo=datetime.timezone.utc).timestamp())*10**9
+
+def encode_chunk(times, kinds, prices, level=6):
+  """Compress rows into a chunk with its header."""
+  times = np.asarray(times, dtype='<i8')
+  payload = b''.join((
+    (times - times[0]).tobytes(),
+    np.asarray(kinds, dtype=np.uint8).tobytes(),
+    np.ascontiguousarray(np.asarray(prices, dtype='<f8').T).tobytes()))
+  payload = zlib.compress(payload, level)
+  return CHUNK.pack(CHUNK_MAGIC, len(times), len(payload),
+                    int(times[0]), int(times[-1])) + payload
+
+def decode_chunk(header, payload):
+  """Decompress chunk rows into backtest Data."""
+  _, rows, _, first, _ = header
+  raw = zlib.decompress(payload)
+  times = np.frombuffer(raw, dtype='<i8', count=rows) + first
+  kind = np.frombuffer(raw, dtype=np.uint8, count=rows, offset=8*rows)
+  prices = np.frombuffer(raw, dtype='<f8', count=4*rows, offset=9*rows)
+  return backtest.Data(kind=kind, time=times, prices=prices.reshape(4, rows).T)
+
+def read_index(fname):
+  """Chunks of a partition file as (first, last, offset, rows) tuples.
+  Chunks written after the last index record, for example when
+  the recorder was stopped abruptly, are found from their headers.
+  """
+  chunks = list()
+  if os.path.exists(fname + ".idx"):
+    index = np.fromfile(fname + ".idx", dtype=INDEX_DTYPE)
+    chunks = list(zip(index['first'].tolist(), index['last'].tolist(),
+                      index['offset'].tolist(), index['rows'].tolist()))
+  size = os.path.getsize(fname)
+  with open(fname, 'rb') as f:
+    offset = 0
+    if chunks:
+      f.seek(chunks[-1][2])
+      offset = chunks[-1][2] + CHUNK.size + CHUNK.unpack(f.read(CHUNK.size))[2]
+    while offset + CHUNK.size <= size:
+      f.seek(offset)
+      magic, rows, length, first, last = CHUNK.unpack(f.read(CHUNK.size))
+      if magic != CHUNK_MAGIC or offset + CHUNK.size + length > size:
+        break # Partially written chunk
+      chunks.append((first, last, offset, rows))
+      offset += CHUNK.size + length
+  return chunks
+
+def partitions(path, start=None, end=None):
+  """Partition files of a symbol directory overlapping [start, end)."""
+  fnames = sorted(f for f in os.listdir(path) if f.endswith(SUFFIX))
+  starts = [_partition_start(f) for f in fnames]
+  for i, fname in enumerate(fnames):
+    if end is not None and starts[i] >= end:
+      break
+    if start is not None and i+1 < len(fnames) and starts[i+1] <= start:
+      continue
+    yield os.path.join(path, fname)
+
+def load(path, start=None, end=None):
+  """Load recorded rows of a symbol directory within a time range.
+  :param path: symbol directory written by the Recorder
+  :param start: first time in nanoseconds since epoch, from the beginning if None
+  :param end: time in nanoseconds to stop before, until the end if None
+  :return: backtest Data
+  """
+  parts = list()
+  for fname in partitions(path, start, end):
+    with open(fname, 'rb') as f:
+      for first, last, offset, _ in read_index(fname):
+        if (start is not None and last < start) or (end is not None and first >= end):
+          continue
+        f.seek(offset)
+        header = CHUNK.unpack(f.read(CHUNK.size))
+        data = decode_chunk(header, f.read(header[2]))
+        mask = np.ones(len(data.time), dtype=bool)
+        if start is not None:
+          mask &= data.time >= start
+        if end is not None:
+          mask &= data.time < end
+        parts.append(data if mask.all() else backtest.Data(*(a[mask] for a in data)))
+  if not parts:
+    return backtest.Data(kind=np.zeros(0, dtype=np.uint8), time=np.zeros(0, dtype=np.int64),
+                         prices=np.zeros((0, 4)))
+  return backtest.Data(kind=np.concatenate([p.kind for p in parts]),
+                       time=np.concatenate([p.time for p in parts]),
+                       prices=np.concatenate([p.prices for p in parts]))
+
+def is_archive(path):
+  """Check if given path is a recorded symbol directory."""
+  return os.path.isdir(path) and any(f.endswith(SUFFIX) for f in os.listdir(path))
+
+
+class Recorder:
+  """Buffer rows per symbol and append them as compressed chunks."""
+  def __init__(self, path, partition=3600, chunk_size=4096, level=6):
+    self.path = path # Root directory with a directory per symbol
+    self.partition = int(partition*10**9) # Partition length in nanoseconds
+    self.chunk_size = chunk_size # Rows per chunk
+    self.level = level # zlib compression level
+    self.rows = 0 # Number of rows written
+    self._buffers = dict() # Symbol name to pending (times, kinds, prices)
+    self._files = dict() # Symbol name to (partition start, data file, index file)
+
+  def add(self, symbol, kind, timestamp, prices):
+    """Add a tick or bar row of a symbol."""
+    times, kinds, rows = self._buffers.setdefault(symbol, (list(), list(), list()))
+    if times and timestamp // self.partition != times[0] // self.partition:
+      # Chunks never span partitions
+      self.flush(symbol)
+      times, kinds, rows = self._buffers[symbol]
+    times.append(timestamp)
+    kinds.append(kind)
+    rows.append(prices)
+    if len(times) >= self.chunk_size:
+      self.flush(symbol)
+
+  def add_frame(self, frame, received=None):
+    """Add all records of a decoded ticker frame."""
+    symbol = protocol.symbol_name(frame.symbol) or "default"
+    timestamp = frame.timestamp or received or time.time_ns()
+    nan = float('nan')
+    for row in protocol.unpack(frame):
+      if frame.type == protocol.TICK:
+        self.add(symbol, backtest.TICK, timestamp, row + (nan, nan))
+      else:
+        self.add(symbol, backtest.BAR, timestamp, row)
+
+  def _open(self, symbol, start):
+    """Partition files of a symbol for rows starting at start."""
+    current = self._files.get(symbol)
+    if current is not None and current[0] == start:
+      return current
+    if current is not None:
+      current[1].close()
+      current[2].close()
+    directory = os.path.join(self.path, symbol)
+    os.makedirs(directory, exist_ok=True)
+    fname = os.path.join(directory, _partition_name(start))
+    logger.info("Recording %s to %s", symbol, fname)
+    data = open(fname, 'ab')
+    # Drop index records past the last complete chunk, read_index
+    # recovers chunks that were written without their record
+    chunks = read_index(fname) if data.tell() else list()
+    with open(fname + ".idx", 'wb') as index:
+      for chunk in chunks:
+        index.write(INDEX.pack(*chunk))
+    current = self._files[symbol] = (start, data, open(fname + ".idx", 'ab'))
+    return current
+
+  def flush(self, symbol=None):
+    """Write buffered rows of a symbol or all symbols as chunks."""
+    for name in [symbol] if symbol is not None else list(self._buffers.keys()):
+      times, kinds, rows = self._buffers.get(name, (None, None, None))
+      if not times:
+        continue
+      _, data, index = self._open(name, times[0] // self.partition * self.partition)
+      offset = data.tell()
+      data.write(encode_chunk(times, kinds, rows, self.level))
+      data.flush()
+      index.write(INDEX.pack(times[0], times[-1], offset, len(times)))
+      index.flush()
+      self.rows += len(times)
+      self._buffers[name] = (list(), list(), list())
+
+  def close(self):
+    """Flush pending rows and close all files."""
+    self.flush()
+    for _, data, index in self._files.values():
+      data.close()
+      index.close()
+    self._files.clear()
+
+def record(ticker, path, symbols=None, names=None, flush_interval=5.0, **kwargs):
+  """Subscribe to a ticker and record updates until interrupted.
+  :param symbols: only record these symbols, all if empty
+  :param names: symbol names to recognise when recording all symbols
+  """
+  recorder = Recorder(path, **kwargs)
+  socket = zmq.Context.instance().socket(zmq.SUB)
+  if not symbols:
+    for name in names or list():
+      protocol.symbol_id(name)
+    socket.setsockopt(zmq.SUBSCRIBE, bytes())
+  for symbol in symbols or list():
+    sid = protocol.symbol_id(symbol)
+    socket.setsockopt(zmq.SUBSCRIBE, protocol.topic(protocol.TICK, sid))
+    socket.setsockopt(zmq.SUBSCRIBE, protocol.topic(protocol.BAR, sid))
+  logger.info("Connecting to ticker: %s", ticker)
+  socket.connect(ticker)
+  flushed = time.monotonic()
+  try:
+    while True:
+      if socket.poll(int(flush_interval*1000)):
+        raw = socket.recv()
+        frame = protocol.decode(raw)
+        if frame is None:
+          logger.error("Malformed ticker message of %s bytes.", len(raw))
+          continue
+        recorder.add_frame(frame, time.time_ns())
+      if time.monotonic() - flushed >= flush_interval:
+        # Bound data lost on a crash for slow symbols
+        recorder.flush()
+        flushed = time.monotonic()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    recorder.close()
+    socket.close()
+    logger.info("Recorded %s rows.", recorder.rows)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, fromfile_prefix_chars='@')
+  parser.add_argument("-t", "--ticker", default="tcp://localhost:7000", help="Ticker endpoint.")
+  parser.add_argument("-o", "--output", default="records", help="Directory to record into.")
+  parser.add_argument("-y", "--symbols", nargs='+', help="Only record these symbols.")
+  parser.add_argument("-n", "--names", nargs='+',
+                      help="Names of symbols when recording all, others are recorded by numeric id.")
+  parser.add_argument("-p", "--partition", default=3600, type=float, help="Seconds per file.")
+  parser.add_argument("-c", "--chunk", default=4096, type=int, help="Rows per compressed chunk.")
+  parser.add_argument("-f", "--flush", default=5.0, type=float, help="Seconds between flushes.")
+  ARGS = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+  record(ARGS.ticker, ARGS.output, symbols=ARGS.symbols, names=ARGS.names, flush_interval=ARGS.flush,
+         partition=ARGS.partition, chunk_size=ARGS.chunk)
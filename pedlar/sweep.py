@@ -0,0 +1,97 @@
+"""Parallel parameter sweep of agents over a backtest file."""
+import argparse
+import ast
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import importlib
+import itertools
+import os
+import tempfile
+
+from . import backtest
+
+# Backtest data shared by every run in a worker process
+_DATA = None
+
+
+def _init_worker(fname):
+  """Memory map backtest data once per worker process."""
+  global _DATA # pylint: disable=global-statement
+  _DATA = backtest.load(fname)
+
+def _run(agent_cls, fname, params):
+  """Run a single backtest with given parameters."""
+  agent = agent_cls(backtest=fname, **params)
+  # Agents tend to print a lot, keep the table readable
+  with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+    agent.local_run(data=_DATA)
+  return dict(params, balance=round(agent.balance, 2), trades=agent.trades,
+              drawdown=round(agent.drawdown, 2))
+
+def grid_params(grid):
+  """Expand parameter grid into list of keyword arguments.
+  :param grid: dictionary of parameter name to list of values
+  """
+  names = sorted(grid)
+  return [dict(zip(names, values)) for values in itertools.product(*(grid[n] for n in names))]
+
+def sweep(agent_cls, grid, fname, workers=None):
+  """Backtest an agent for every combination of parameters.
+  CSV files and recorded symbol directories are converted once into a
+  binary tick store that every worker memory maps, so the data is parsed
+  once and shared read-only through the page cache.
+  :param agent_cls: Agent subclass to instantiate
+  :param grid: dictionary of parameter name to list of values
+  :param fname: backtest file or recorded symbol directory
+  :param workers: number of processes, defaults to cpu count
+  :return: list of result rows with balance, trades and drawdown
+  """
+  params = grid_params(grid)
+  tmpname = None
+  if os.path.isdir(fname) or not backtest.is_bin(fname):
+    fd, tmpname = tempfile.mkstemp(suffix='.pdb')
+    os.close(fd)
+    backtest.save_bin(tmpname, backtest.load(fname))
+  shared = tmpname or fname
+  try:
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(shared,)) as executor:
+      results = list(executor.map(_run, itertools.repeat(agent_cls),
+                                  itertools.repeat(fname), params))
+  finally:
+    if tmpname:
+      os.remove(tmpname)
+  return results
+
+def format_table(results):
+  """Format result rows as a tab separated table."""
+  if not results:
+    return ""
+  header = list(results[0].keys())
+  lines = ["\t".join(header)]
+  lines.extend("\t".join(str(r[h]) for h in header) for r in results)
+  return "\n".join(lines)
+
+def load_class(path):
+  """Import agent class from dotted path, ex. pedlar.basic.BasicAgent"""
+  module, _, name = path.rpartition('.')
+  return getattr(importlib.import_module(module), name)
+
+def parse_grid(specs):
+  """Parse name=v1,v2 parameter specifications."""
+  grid = dict()
+  for spec in specs:
+    name, _, values = spec.partition('=')
+    grid[name] = [ast.literal_eval(v) for v in values.split(',')]
+  return grid
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, fromfile_prefix_chars='@')
+  parser.add_argument("agent", help="Agent class, ex. pedlar.basic.BasicAgent")
+  parser.add_argument("-b", "--backtest", required=True, help="Backtest agaisnt given file.")
+  parser.add_argument("-g", "--grid", nargs='+', default=list(),
+                      help="Parameter values, ex. histsize=10,20,40")
+  parser.add_argument("-j", "--jobs", type=int, help="Number of worker processes.")
+  ARGS = parser.parse_args()
+  print(format_table(sweep(load_class(ARGS.agent), parse_grid(ARGS.grid),
+                           ARGS.backtest, workers=ARGS.jobs)))
@@ -23,11 +23,17 @@ db = SQLAlchemy(app)
 from flask_socketio import SocketIO
 socketio = SocketIO(app)
 
+from pedlar.metrics import Metrics
+metrics = Metrics(app.config.get('METRICS', False))
+
 from .flask_broker import Broker
 broker = Broker(app)
 
 from .flask_ticker import Ticker
 ticker = Ticker(app, socketio)
 
+from .flask_channel import Channel
+channel = Channel(app)
+
 # Load view endpoints
 from . import views
@@ -1,9 +1,13 @@
 """Broker extension for Flask."""
-import struct
-from flask import current_app, _app_ctx_stack, abort
+from contextlib import contextmanager
+import time
+from flask import current_app, abort
 
+from eventlet.queue import LightQueue, Empty
 from eventlet.green import zmq
 
+from pedlar.protocol import REQUEST, RESPONSE, MAX_BATCH, pack_requests, unpack_responses
+
 # Context are thread safe already,
 # we'll create one global one for all sockets
 context = zmq.Context()
@@ -12,6 +16,8 @@ class Broker:
   """Handle ZMQ connection to broker."""
   def __init__(self, app=None):
     self.app = app
+    self._pool = LightQueue() # Idle (socket, last used) pairs
+    self._size = 0 # Number of open sockets
     if app is not None:
       self.init_app(app)
 
@@ -20,7 +26,11 @@ class Broker:
     app.config.setdefault('BROKER_URL', "tcp://localhost:7100")
     app.config.setdefault('BROKER_TIMEOUT', 4000)
     app.config.setdefault('BROKER_LINGER', 2000)
-    app.teardown_appcontext(self.teardown)
+    app.config.setdefault('BROKER_BATCH_SIZE', MAX_BATCH)
+    app.config.setdefault('BROKER_POOL_SIZE', 8)
+    app.config.setdefault('BROKER_HEALTH_INTERVAL', 30000)
+    if app.config['BROKER_BATCH_SIZE'] > MAX_BATCH:
+      raise ValueError("BROKER_BATCH_SIZE exceeds {} requests of the broker.".format(MAX_BATCH))
 
   @staticmethod
   def connect():
@@ -32,21 +42,68 @@ class Broker:
     socket.connect(current_app.config['BROKER_URL'])
     return socket
 
-  @property
-  def connection(self):
-    """Broker connection socket."""
-    ctx = _app_ctx_stack.top
-    if not hasattr(ctx, 'broker'):
-      ctx.broker = self.connect()
-    return ctx.broker
-
   @staticmethod
-  def teardown(_):
-    """Clean up socket."""
-    ctx = _app_ctx_stack.top
-    if hasattr(ctx, 'broker'):
-      current_app.logger.debug("Disconnecting from broker: %s", current_app.config['BROKER_URL'])
-      ctx.broker.close()
+  def ping(socket):
+    """Check socket health with an empty request.
+    Unknown actions are answered with a failure response by brokers.
+    :return: true if broker responded false otherwise
+    """
+    try:
+      socket.send(REQUEST.pack(0, 0.0, 0))
+      return len(socket.recv()) == RESPONSE.size
+    except zmq.ZMQError:
+      return False
+
+  def _discard(self, socket):
+    """Close a socket that is no longer usable."""
+    self._size -= 1
+    current_app.logger.debug("Disconnecting from broker: %s", current_app.config['BROKER_URL'])
+    socket.close(linger=0)
+
+  def _connect(self):
+    """Connect a new pooled socket, counted only if it connects."""
+    self._size += 1
+    try:
+      return self.connect()
+    except zmq.ZMQError:
+      self._size -= 1
+      raise
+
+  def _acquire(self):
+    """Get an idle socket from the pool or connect a new one."""
+    try:
+      socket, last_used = self._pool.get_nowait()
+    except Empty:
+      if self._size < current_app.config['BROKER_POOL_SIZE']:
+        return self._connect()
+      # Wait for a socket to be released
+      try:
+        socket, last_used = self._pool.get(timeout=current_app.config['BROKER_TIMEOUT']/1000)
+      except Empty:
+        # zmq errors format their errno only, so log the reason here
+        current_app.logger.error("No broker connection available, all %s in use.",
+                                 current_app.config['BROKER_POOL_SIZE'])
+        raise zmq.Again() from None
+    idle = (time.monotonic() - last_used)*1000
+    if idle > current_app.config['BROKER_HEALTH_INTERVAL'] and not self.ping(socket):
+      current_app.logger.warning("Broker connection failed health check.")
+      self._discard(socket)
+      return self._connect()
+    return socket
+
+  @contextmanager
+  def connection(self):
+    """Borrow a pooled broker connection socket.
+    A REQ socket that failed mid request cannot be reused,
+    so it is closed and replaced on the next acquire.
+    """
+    socket = self._acquire()
+    try:
+      yield socket
+    except:
+      self._discard(socket)
+      raise
+    self._pool.put((socket, time.monotonic()))
 
   @staticmethod
   def validate(req):
@@ -61,16 +118,18 @@ class Broker:
 
   def talk(self, order_id=0, volume=0.01, action=0):
     """Round of request-response with broker."""
-    # Prepare request, ulong order_id, double volume, uchar action
-    req = struct.pack('LdB', order_id, volume, action)
-    sock = self.connection
-    # Handled in a non-blocking fashion by eventlet
-    sock.send(req)
-    # Check response
-    resp = sock.recv()
-    # ulong order_id, double price, double profit, uint retcode
-    order_id, price, profit, retcode = struct.unpack('LddI', resp)
-    return {'order_id': order_id, 'price': price, 'profit': profit, 'retcode': retcode}
+    return self.talk_many([{'order_id': order_id, 'volume': volume, 'action': action}])[0]
+
+  def talk_many(self, requests):
+    """Single round of request-response with broker for many requests."""
+    # Requests are packed back to back in a single message
+    req = pack_requests(requests)
+    with self.connection() as sock:
+      # Handled in a non-blocking fashion by eventlet
+      sock.send(req)
+      # Check response
+      resp = sock.recv()
+    return unpack_responses(resp)
 
   def handle(self, request):
     """Handle a client request."""
@@ -78,12 +137,11 @@ class Broker:
     if not self.validate(request):
       abort(400)
     # Make the request to the broker
-    resp = {'retcode': -1} # Assume failure
     try:
       resp = self.talk(**request)
     except zmq.Again:
       current_app.logger.error("Broker response timed out.")
-      # abort(504) # Gateway Timeout
+      abort(504) # Gateway Timeout
     # Check response conditions
     if resp['retcode'] != 0:
       current_app.logger.error("Broker returned a non-zero return code.")
@@ -93,3 +151,29 @@ class Broker:
       current_app.logger.error("Broker did not place order.")
       abort(503)
     return resp
+
+  def handle_many(self, requests):
+    """Handle a batch of client requests in one broker round trip.
+    Unlike handle, failed requests are reported through their return codes.
+    """
+    # Validate requests first
+    if (not isinstance(requests, list) or not requests or
+        len(requests) > current_app.config['BROKER_BATCH_SIZE'] or
+        not all(isinstance(r, dict) and self.validate(r) for r in requests)):
+      abort(400)
+    try:
+      resps = self.talk_many(requests)
+    except zmq.Again:
+      current_app.logger.error("Broker response timed out.")
+      abort(504) # Gateway Timeout
+    if len(resps) != len(requests):
+      current_app.logger.error("Broker returned %s responses for %s requests.",
+                               len(resps), len(requests))
+      abort(503)
+    for req, resp in zip(requests, resps):
+      if resp['retcode'] != 0:
+        current_app.logger.error("Broker returned a non-zero return code.")
+      elif req['action'] in (2, 3) and resp['order_id'] == 0:
+        current_app.logger.error("Broker did not place order.")
+        resp['retcode'] = 503 # Same as single requests
+    return resps
@@ -0,0 +1,79 @@
+"""Direct ZMQ trading channel extension for Flask."""
+from werkzeug.exceptions import HTTPException
+from eventlet import GreenPool, spawn_n
+from eventlet.green import zmq
+
+from pedlar.protocol import REQUEST, RESPONSE
+
+# Context are thread safe already,
+# we'll create one global one for all sockets
+context = zmq.Context()
+
+class Channel:
+  """Serve agent trade requests over a ZMQ ROUTER socket.
+  Messages end with token, agent name and requests packed back to back,
+  preceding envelope frames are echoed back with the packed responses.
+  Failures of the whole message are a single response whose retcode is
+  the equivalent HTTP status code.
+  """
+  def __init__(self, app=None):
+    self.app = app
+    self._handler = None # Called with token, agent name and request dictionaries
+    if app is not None:
+      self.init_app(app)
+      if app.config['CHANNEL_URL']:
+        spawn_n(self.run)
+
+  @staticmethod
+  def init_app(app):
+    """Initialise extension."""
+    app.config.setdefault('CHANNEL_URL', "")
+    app.config.setdefault('CHANNEL_WORKERS', 16)
+
+  def handler(self, func):
+    """Register trade handler, it returns response dictionaries or aborts."""
+    self._handler = func
+    return func
+
+  @staticmethod
+  def failure(code):
+    """Packed response for a failed message."""
+    return RESPONSE.pack(0, 0.0, 0.0, code)
+
+  def handle(self, token, name, raw):
+    """Handle a single message of packed requests.
+    :return: packed responses
+    """
+    if not raw or len(raw) % REQUEST.size:
+      return self.failure(400)
+    reqs = [{'order_id': order_id, 'volume': volume, 'action': action}
+            for order_id, volume, action in REQUEST.iter_unpack(raw)]
+    with self.app.app_context():
+      try:
+        resps = self._handler(token.decode(), name.decode(errors='replace'), reqs)
+      except HTTPException as e:
+        return self.failure(e.code)
+      except Exception: # pylint: disable=broad-except
+        self.app.logger.exception("Failed to handle channel request.")
+        return self.failure(500)
+    return b''.join([RESPONSE.pack(r['order_id'], r['price'], r['profit'], r['retcode'])
+                     for r in resps])
+
+  def _reply(self, socket, frames):
+    """Handle message frames and reply with the same envelope."""
+    if len(frames) < 4:
+      # At least identity, token, name and requests
+      socket.send_multipart(frames[:1] + [self.failure(400)])
+      return
+    socket.send_multipart(frames[:-3] + [self.handle(*frames[-3:])])
+
+  def run(self):
+    """Bind channel and serve requests concurrently."""
+    socket = context.socket(zmq.ROUTER)
+    socket.bind(self.app.config['CHANNEL_URL'])
+    self.app.logger.info("Trading channel listening on: %s", self.app.config['CHANNEL_URL'])
+    pool = GreenPool(self.app.config['CHANNEL_WORKERS'])
+    while True:
+      frames = socket.recv_multipart()
+      # Blocks when all workers are busy
+      pool.spawn_n(self._reply, socket, frames)
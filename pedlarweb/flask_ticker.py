@@ -1,44 +1,148 @@
 """Ticker extension for Flask."""
-import struct
+from functools import partial
+import time
 from flask import current_app
 
-from eventlet import spawn_n
+from eventlet import spawn_n, sleep
 from eventlet.green import zmq
 
+from pedlar import protocol
+
 # Context are thread safe already,
 # we'll create one global one for all sockets
 context = zmq.Context()
 
-class Ticker:
+class Ticker: # pylint: disable=too-many-instance-attributes
   """Handle ZMQ connection to broker."""
   def __init__(self, app=None, socketio=None):
     self.app = app
     self.socketio = socketio
+    self._windows = dict() # Symbol id, None for any, to ticks coalesced since last frame
+    self._rooms = dict() # Symbol id to client sid to time of unacknowledged frame if any
+    self._clients = dict() # Client sid to symbol id of its room
+    self._sequences = protocol.Sequences() # Ticker sequence tracking
+    self._listeners = list() # Called with symbol id, bid, ask of every message
+    self.stats = {'ticks': 0, 'frames': 0, 'emits': 0, 'drops': 0,
+                  'lag': 0.0, 'ack_lag': 0.0, 'gaps': 0, 'missed': 0,
+                  'latency': 0.0}
     if app is not None:
       self.init_app(app)
     spawn_n(self.run) # spawns eventlet co-routine
+    spawn_n(self.fanout)
 
   @staticmethod
   def init_app(app):
     """Initialise extension."""
     app.config.setdefault('TICKER_URL', "tcp://localhost:7000")
+    app.config.setdefault('TICKER_INTERVAL', 250)
+    app.config.setdefault('TICKER_ACK_TIMEOUT', 5000)
+    app.config.setdefault('TICKER_SYMBOLS', list())
     # We want the connection live forever
     # app.teardown_appcontext(self.teardown)
 
+  def add_listener(self, func):
+    """Call func(symbol_id, bid, ask) with the latest tick of every message."""
+    self._listeners.append(func)
+
+  def add_client(self, sid, symbol=""):
+    """Start sending frames of a symbol to a websocket client.
+    :param symbol: symbol name, latest ticks of any symbol if empty
+    """
+    self.remove_client(sid)
+    key = protocol.symbol_id(symbol) if symbol else None
+    self._clients[sid] = key
+    self._rooms.setdefault(key, dict())[sid] = None
+
+  def remove_client(self, sid):
+    """Stop sending frames to a websocket client."""
+    if sid not in self._clients:
+      return
+    key = self._clients.pop(sid)
+    room = self._rooms[key]
+    del room[sid]
+    if not room:
+      del self._rooms[key]
+
+  def _update(self, key, symbol, bid, ask):
+    """Coalesce a tick into the window of a room."""
+    window = self._windows.get(key)
+    if window is None:
+      self._windows[key] = {'symbol': symbol, 'bid': bid, 'ask': ask, 'high': bid,
+                            'low': bid, 'received': time.monotonic()}
+    else:
+      window['symbol'], window['bid'], window['ask'] = symbol, bid, ask
+      window['high'] = max(window['high'], bid)
+      window['low'] = min(window['low'], bid)
+
   def run(self):
-    """Connect to ticker server and emit updates."""
+    """Connect to ticker server and coalesce updates."""
     socket = context.socket(zmq.SUB)
-    # Set topic filter, this is a binary prefix
-    # to check for each incoming message
-    # set from server as uchar topic = X
-    # We'll subsribe to only tick updates for now
-    socket.setsockopt(zmq.SUBSCRIBE, bytes.fromhex('00'))
     with self.app.app_context():
+      # Set topic filter, this is a binary prefix
+      # to check for each incoming message
+      # We'll subsribe to only tick updates of configured symbols
+      symbols = current_app.config['TICKER_SYMBOLS']
+      for symbol in symbols:
+        socket.setsockopt(zmq.SUBSCRIBE, protocol.topic(protocol.TICK, protocol.symbol_id(symbol)))
+      if not symbols:
+        socket.setsockopt(zmq.SUBSCRIBE, protocol.topic(protocol.TICK))
       current_app.logger.debug("Connecting to ticker: %s", current_app.config['TICKER_URL'])
       socket.connect(current_app.config['TICKER_URL'])
       while True:
-        raw = socket.recv()
-        # unpack bytes https://docs.python.org/3/library/struct.html
-        bid, ask = struct.unpack_from('dd', raw, 1) # offset topic
-        self.socketio.emit('tick', {'bid': round(bid, 5), 'ask': round(ask, 5)})
+        frame = protocol.decode(socket.recv())
+        if frame is None:
+          current_app.logger.warning("Malformed ticker message.")
+          continue
+        if frame.timestamp:
+          # End to end latency, assumes synchronised clocks
+          self.stats['latency'] = (time.time_ns() - frame.timestamp)/1e9
+        if self._sequences.check(frame) is not None:
+          # Browsers only see the latest prices so missed ticks are counted only
+          self.stats['gaps'] = self._sequences.gaps
+          self.stats['missed'] = self._sequences.missed
+        symbol = protocol.symbol_name(frame.symbol)
+        for bid, ask in protocol.unpack(frame):
+          self.stats['ticks'] += 1
+          # Only coalesce ticks someone is watching
+          if frame.symbol in self._rooms:
+            self._update(frame.symbol, symbol, bid, ask)
+          if None in self._rooms:
+            self._update(None, symbol, bid, ask)
+        if self._listeners:
+          # Listeners only need the latest prices of a frame
+          bid, ask = protocol.last(frame)
+          for listener in self._listeners:
+            listener(frame.symbol, bid, ask)
     # socket will be cleaned up at garbarge collection
+
+  def _ack(self, room, sid, sent, *_):
+    """Client acknowledged a frame and can receive the next one."""
+    if room.get(sid) == sent:
+      room[sid] = None
+      self.stats['ack_lag'] = time.monotonic() - sent
+
+  def fanout(self):
+    """Emit coalesced frames at a fixed interval.
+    Clients still processing a previous frame skip the current one
+    and receive the latest prices on the next interval instead.
+    """
+    with self.app.app_context():
+      interval = current_app.config['TICKER_INTERVAL']/1000
+      timeout = current_app.config['TICKER_ACK_TIMEOUT']/1000
+      while True:
+        sleep(interval)
+        windows, self._windows = self._windows, dict()
+        now = time.monotonic()
+        for key, window in windows.items():
+          room = self._rooms.get(key, dict())
+          frame = {k: round(window[k], 5) for k in ('bid', 'ask', 'high', 'low')}
+          frame['symbol'] = window['symbol']
+          self.stats['frames'] += 1
+          self.stats['lag'] = now - window['received']
+          for sid, sent in list(room.items()):
+            if sent is not None and now - sent < timeout:
+              self.stats['drops'] += 1
+              continue
+            room[sid] = now
+            self.socketio.emit('tick', frame, room=sid, callback=partial(self._ack, room, sid, now))
+            self.stats['emits'] += 1
@@ -0,0 +1,59 @@
+"""In memory leaderboard for pedlarweb."""
+import bisect
+
+from .models import User
+
+
+class Leaderboard:
+  """User balances kept sorted in memory.
+  Built once from the database on first use and then updated
+  incrementally as balances change, assumes a single server process.
+  """
+  def __init__(self):
+    self._keys = None # Sorted (-balance, user_id) pairs
+    self._users = dict() # user_id to (username, balance)
+    self._last = None # Last broadcasted top entries
+
+  def rebuild(self):
+    """Load all user balances from the database."""
+    rows = User.query.with_entities(User.id, User.username, User.balance).all()
+    self._users = {uid: (username, balance) for uid, username, balance in rows}
+    self._keys = sorted((-balance, uid) for uid, (_, balance) in self._users.items())
+
+  def _check(self):
+    """Build leaderboard if not built yet."""
+    if self._keys is None:
+      self.rebuild()
+
+  def remove(self, user_id):
+    """Remove user from leaderboard if present."""
+    self._check()
+    entry = self._users.pop(user_id, None)
+    if entry is not None:
+      idx = bisect.bisect_left(self._keys, (-entry[1], user_id))
+      del self._keys[idx]
+
+  def update(self, user_id, username, balance):
+    """Insert or move user with new balance."""
+    self.remove(user_id)
+    self._users[user_id] = (username, balance)
+    bisect.insort(self._keys, (-balance, user_id))
+
+  def entry(self, user_id):
+    """Return (username, balance) of a user, None if unknown."""
+    self._check()
+    return self._users.get(user_id)
+
+  def top(self, size):
+    """Return top users by balance."""
+    self._check()
+    return [{'username': self._users[uid][0], 'balance': -nbal}
+            for nbal, uid in self._keys[:size]]
+
+  def changed(self, size):
+    """Return top users if they changed since last call, None otherwise."""
+    leaders = self.top(size)
+    if leaders == self._last:
+      return None
+    self._last = leaders
+    return leaders
@@ -1,7 +1,19 @@
 """pedlarweb data models."""
 import datetime
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
 from . import bcrypt, db, login_manager, app
 
+# Bcrypt is CPU bound but releases the GIL, hashing in native threads
+# keeps other green threads running while bounding the CPU used by logins
+app.config.setdefault('BCRYPT_THREADS', 4)
+_hashing = Semaphore(app.config['BCRYPT_THREADS'])
+
+def offload(func, *args):
+  """Run a CPU bound function in a native thread without blocking green threads."""
+  with _hashing:
+    return tpool.execute(func, *args)
+
 
 class User(db.Model):
   """Single user instance."""
@@ -21,13 +33,13 @@ class User(db.Model):
 
   @password.setter
   def password(self, plaintext):
-    self._password = bcrypt.generate_password_hash(plaintext)
+    self._password = offload(bcrypt.generate_password_hash, plaintext)
 
   def is_correct_password(self, plaintext):
     """Check plaintext password against hash.
     :return: true if correct false otherwise
     """
-    return bcrypt.check_password_hash(self._password, plaintext)
+    return offload(bcrypt.check_password_hash, self._password, plaintext)
 
   @property
   def is_active(self):
@@ -57,6 +69,9 @@ def load_user(user_id):
 
 class Order(db.Model):
   """Single trade order."""
+  # Recent and open orders are always looked up per user
+  __table_args__ = (db.Index('ix_order_user_created', 'user_id', 'created'),
+                    db.Index('ix_order_user_closed', 'user_id', 'closed'))
   id = db.Column(db.Integer, primary_key=True)
   user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
   agent = db.Column(db.String(128))
@@ -0,0 +1,152 @@
+"""Mark-to-market valuation of open orders for pedlarweb."""
+from flask import current_app
+from eventlet import spawn_n, sleep
+import numpy as np
+
+from pedlar import protocol
+from .models import Order
+
+
+class Pnl:
+  """Open orders kept in arrays and valued on the latest tick.
+  Buy orders close on bid and sell orders on ask with the profit formula
+  of the broker, k*(bid - open)/bid for buys and k*(open - ask)/ask for
+  sells where k is leverage*volume*1000. Summing k and k*open per user
+  and side once the book changes makes every revaluation cost a few
+  vector operations over users, no matter how many orders are open.
+  """
+  def __init__(self, app, socketio, leaderboard):
+    self.app = app
+    self.socketio = socketio
+    self.leaderboard = leaderboard # Realised balances and usernames
+    app.config.setdefault('PNL_LEVERAGE', 100)
+    app.config.setdefault('PNL_INTERVAL', 1000)
+    app.config.setdefault('PNL_SYMBOL', "")
+    self.leverage = app.config['PNL_LEVERAGE']
+    symbol = app.config['PNL_SYMBOL']
+    self._symbol = protocol.symbol_id(symbol) if symbol else None
+    self._slots = None # Order id to row in the arrays
+    self._size = 0 # Number of open orders
+    self._ids = np.zeros(0, dtype=np.int64) # Order ids
+    self._users = np.zeros(0, dtype=np.int64) # User ids
+    self._buys = np.zeros(0, dtype=bool) # Buy or sell
+    self._factors = np.zeros(0) # leverage*volume*1000
+    self._prices = np.zeros(0) # Open prices
+    self._sums = None # Unique user ids and per user sums of factors, factor*price
+    self._tick = None # Latest (bid, ask)
+    self.unrealized = dict() # User id to last published unrealized profit
+    spawn_n(self.run)
+
+  def rebuild(self):
+    """Load all open orders from the database."""
+    rows = Order.query.filter_by(closed=None).\
+                 with_entities(Order.id, Order.user_id, Order.type,
+                               Order.price_open, Order.volume).all()
+    self._slots, self._size = dict(), 0
+    self._grow(len(rows))
+    for oid, uid, otype, price, volume in rows:
+      self._append(oid, uid, otype == "BUY", price, volume)
+
+  def _check(self):
+    """Load open orders if not loaded yet."""
+    if self._slots is None:
+      self.rebuild()
+
+  def _grow(self, size):
+    """Make room for at least size orders, doubling capacity."""
+    if size <= len(self._ids):
+      return
+    capacity = max(size, 2*len(self._ids), 1024)
+    for name in ('_ids', '_users', '_buys', '_factors', '_prices'):
+      old = getattr(self, name)
+      new = np.zeros(capacity, dtype=old.dtype)
+      new[:self._size] = old[:self._size]
+      setattr(self, name, new)
+
+  def _append(self, order_id, user_id, buy, price, volume):
+    """Add an order at the end of the arrays."""
+    self._grow(self._size+1)
+    row = self._size
+    self._ids[row], self._users[row], self._buys[row] = order_id, user_id, buy
+    self._factors[row] = self.leverage*volume*1000
+    self._prices[row] = price
+    self._slots[order_id] = row
+    self._size += 1
+    self._sums = None
+
+  def add(self, order_id, user_id, otype, price, volume):
+    """Track a new open order.
+    :param otype: BUY or SELL
+    """
+    self._check()
+    if order_id not in self._slots:
+      self._append(order_id, user_id, otype == "BUY", price, volume)
+
+  def remove(self, order_id):
+    """Stop tracking a closed order, the last row takes its place."""
+    self._check()
+    row = self._slots.pop(order_id, None)
+    if row is None:
+      return
+    self._size -= 1
+    last = self._size
+    if row != last:
+      for arr in (self._ids, self._users, self._buys, self._factors, self._prices):
+        arr[row] = arr[last]
+      self._slots[int(self._ids[row])] = row
+    self._sums = None
+
+  def remove_user(self, user_id):
+    """Stop tracking all orders of a user."""
+    self._check()
+    for oid in self._ids[:self._size][self._users[:self._size] == user_id].tolist():
+      self.remove(oid)
+
+  def on_tick(self, symbol, bid, ask):
+    """Keep the latest prices of the valued symbol, called by the ticker."""
+    if self._symbol is None or symbol == self._symbol:
+      self._tick = (bid, ask)
+
+  def _aggregate(self):
+    """Per user sums of factors and factor weighted open prices by side."""
+    n = self._size
+    users, inverse = np.unique(self._users[:n], return_inverse=True)
+    buys, factors = self._buys[:n], self._factors[:n]
+    sums = list()
+    for side in (buys, ~buys):
+      weights = np.where(side, factors, 0.0)
+      sums.append(np.bincount(inverse, weights=weights, minlength=len(users)))
+      sums.append(np.bincount(inverse, weights=weights*self._prices[:n], minlength=len(users)))
+    self._sums = (users, sums)
+
+  def value(self, bid, ask):
+    """Unrealized profit of every user with open orders.
+    :return: user ids and unrealized profit arrays
+    """
+    self._check()
+    if self._sums is None:
+      self._aggregate()
+    users, (kbuy, obuy, ksell, osell) = self._sums
+    return users, (kbuy - obuy/bid) + (osell/ask - ksell)
+
+  def run(self):
+    """Publish changed equity and unrealized profits at a fixed interval."""
+    with self.app.app_context():
+      interval = current_app.config['PNL_INTERVAL']/1000
+      while True:
+        sleep(interval)
+        if self._tick is None or not all(self._tick):
+          continue
+        users, profits = self.value(*self._tick)
+        unrealized = dict(zip(users.tolist(), np.round(profits, 2).tolist()))
+        changed = {uid: p for uid, p in unrealized.items() if self.unrealized.get(uid) != p}
+        # Users whose last order closed drop back to zero
+        changed.update({uid: 0.0 for uid in self.unrealized.keys() - unrealized.keys()})
+        self.unrealized = unrealized
+        for uid, profit in changed.items():
+          entry = self.leaderboard.entry(uid)
+          if entry is None:
+            continue
+          username, balance = entry
+          self.socketio.emit('pnl', {'unrealized': profit, 'equity': round(balance + profit, 2)},
+                             room=username)
@@ -0,0 +1,59 @@
+"""In memory API tokens for pedlarweb agents."""
+from collections import namedtuple
+import functools
+import secrets
+
+from flask import request, abort
+
+ApiUser = namedtuple('ApiUser', ['id', 'username'])
+
+
+class Tokens:
+  """Agent API tokens kept in memory.
+  A token is issued once per agent connection, trade requests are then
+  authenticated against the cache without loading the user from the
+  database. Tokens do not survive restarts, assumes a single server process.
+  """
+  def __init__(self):
+    self._tokens = dict() # token to ApiUser
+
+  def issue(self, user):
+    """Issue a new token for given user."""
+    token = secrets.token_urlsafe(32)
+    self._tokens[token] = ApiUser(user.id, user.username)
+    return token
+
+  def revoke(self, token):
+    """Revoke a single token if present."""
+    self._tokens.pop(token, None)
+
+  def revoke_user(self, user_id):
+    """Revoke all tokens of a user."""
+    for token in [t for t, u in self._tokens.items() if u.id == user_id]:
+      del self._tokens[token]
+
+  @staticmethod
+  def from_request():
+    """Extract bearer token from current request.
+    :return: token or None if missing
+    """
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return token if scheme == 'Bearer' and token else None
+
+  def get(self, token):
+    """Return user of given token, None if not valid."""
+    return self._tokens.get(token)
+
+  def lookup(self):
+    """Return user of current request token, None if not valid."""
+    return self.get(self.from_request())
+
+  def required(self, func):
+    """Decorate endpoint to require a valid token, user is passed as first argument."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      user = self.lookup()
+      if user is None:
+        abort(401)
+      return func(user, *args, **kwargs)
+    return wrapper
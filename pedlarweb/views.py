@@ -1,13 +1,33 @@
 """Endpoints for the web application."""
 import datetime
 
-from flask import render_template, redirect, url_for, request, jsonify
+from flask import render_template, redirect, url_for, request, jsonify, abort
 from flask_login import login_user, login_required, current_user, logout_user
 from flask_socketio import emit, join_room, leave_room
 
-from . import app, db, broker, socketio
+from . import app, db, broker, socketio, ticker, channel, metrics
 from .forms import UserPasswordForm
+from .leaderboard import Leaderboard
 from .models import User, Order
+from .pnl import Pnl
+from .tokens import Tokens
+from .writebehind import WriteBehind
+
+leaderboard = Leaderboard()
+tokens = Tokens()
+writer = WriteBehind(app, metrics)
+pnl = Pnl(app, socketio, leaderboard)
+ticker.add_listener(pnl.on_tick)
+
+def create_user(username, password):
+  """Create a new user and add to leaderboard."""
+  user = User(username=username, password=password)
+  db.session.add(user)
+  db.session.commit()
+  leaderboard.update(user.id, user.username, user.balance)
+  broadcast_leaders()
+  app.logger.info("New user: %s", user.username)
+  return user
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -24,44 +44,114 @@ def login():
         return redirect(url_for('index'))
       return redirect(url_for('login'))
     # Create new user
-    user = User(username=form.username.data, password=form.password.data)
-    db.session.add(user)
-    db.session.commit()
+    user = create_user(form.username.data, form.password.data)
     login_user(user)
-    app.logger.info("New user: %s", user.username)
     return redirect(url_for('index'))
   return render_template('login.html', form=form)
 
+@app.route('/api/token', methods=['POST'])
+def api_token():
+  """Issue an API token for agents, creates user like the login page."""
+  # Agents send JSON credentials, no CSRF or templates involved
+  form = UserPasswordForm(meta={'csrf': False})
+  if not form.validate_on_submit():
+    return jsonify(errors=form.errors), 400
+  user = User.query.filter_by(username=form.username.data).first()
+  if user is None:
+    user = create_user(form.username.data, form.password.data)
+  elif not user.is_correct_password(form.password.data):
+    abort(401)
+  return jsonify(token=tokens.issue(user))
+
+@app.route('/api/token', methods=['DELETE'])
+def api_token_revoke():
+  """Revoke API token of the request."""
+  tokens.revoke(tokens.from_request())
+  return '', 204
+
 def get_leaders():
-  """Recompute return leaderboard."""
-  leaders = [{'username': u.username, 'balance': u.balance}
-             for u in User.query.order_by(User.balance.desc()).\
-                      limit(app.config['LEADERBOARD_SIZE']).all()]
-  return leaders
+  """Return current leaderboard."""
+  return leaderboard.top(app.config['LEADERBOARD_SIZE'])
+
+def broadcast_leaders():
+  """Send leaderboard update if the rankings changed."""
+  leaders = leaderboard.changed(app.config['LEADERBOARD_SIZE'])
+  if leaders is not None:
+    socketio.emit('leaderboard', leaders)
+
+ORDER_FIELDS = ['id', 'agent', 'type', 'price_open', 'volume',
+                'price_close', 'profit', 'closed', 'created']
 
 def rows_to_dicts(objs, attributes):
-  """Convert SQLAlchemy object to dictionary."""
+  """Convert SQLAlchemy object or dictionary to dictionary."""
   l = list()
   for obj in objs:
     d = dict()
     for att in attributes:
-      elem = getattr(obj, att, None)
+      elem = obj.get(att) if isinstance(obj, dict) else getattr(obj, att, None)
       d[att] = elem
       if elem is not None and isinstance(elem, datetime.datetime):
         d[att] = elem.isoformat()
     l.append(d)
   return l
 
-def get_orders():
-  """Return current user orders."""
-  rows = Order.query.filter_by(user_id=current_user.id).\
-                     order_by(Order.created.desc()).\
-                     limit(app.config['RECENT_ORDERS_SIZE']).all()
-  orders = rows_to_dicts(rows, ['id', 'agent', 'type', 'price_open',
-                                'volume', 'price_close', 'profit',
-                                'closed', 'created'])
+def get_orders(user_id, before=None, limit=None):
+  """Return most recent orders of a user, newest first.
+  :param before: (created, id) key of the last order of the previous page
+  :param limit: number of orders, RECENT_ORDERS_SIZE by default
+  """
+  limit = limit or app.config['RECENT_ORDERS_SIZE']
+  query = Order.query.filter_by(user_id=user_id)
+  if before is not None:
+    # Seek past the previous page instead of counting rows with an offset
+    created, oid = before
+    query = query.filter(db.or_(Order.created < created,
+                                db.and_(Order.created == created, Order.id < oid)))
+  rows = query.order_by(Order.created.desc(), Order.id.desc()).limit(limit).all()
+  if writer.enabled:
+    # Include orders not yet written to the database
+    rows = writer.merge(user_id, [{att: getattr(r, att) for att in ORDER_FIELDS}
+                                  for r in rows],
+                        limit, before)
+  orders = rows_to_dicts(rows, ORDER_FIELDS)
   return orders
 
+def get_order_page(user_id, cursor=None, limit=None):
+  """Page of order history with the cursor of the next page if any.
+  :param cursor: next cursor of the previous page, newest orders if None
+  :raises ValueError: on malformed cursors
+  """
+  before = None
+  if cursor:
+    created, _, oid = cursor.rpartition('_')
+    before = (datetime.datetime.fromisoformat(created), int(oid))
+  limit = max(1, min(limit or app.config['RECENT_ORDERS_SIZE'], app.config['ORDER_PAGE_MAX']))
+  orders = get_orders(user_id, before, limit)
+  last = orders[-1] if len(orders) == limit else None
+  return {'orders': orders,
+          'next': "{}_{}".format(last['created'], last['id']) if last else None}
+
+def order_history(user):
+  """Respond with a page of order history of given user."""
+  try:
+    page = get_order_page(user.id, request.args.get('cursor'),
+                          request.args.get('limit', type=int))
+  except ValueError:
+    abort(400)
+  return jsonify(page)
+
+@app.route('/orders')
+@login_required
+def orders_view():
+  """Order history of the current user, paginated with cursor and limit arguments."""
+  return order_history(current_user)
+
+@app.route('/api/orders')
+@tokens.required
+def api_orders(user):
+  """Token authenticated order history, same as /orders."""
+  return order_history(user)
+
 @app.route('/')
 @login_required
 def index():
@@ -76,66 +166,193 @@ def handle_connect():
   # We join a single room to send unique messages
   # based on rooms from server side
   join_room(current_user.username)
+  ticker.add_client(request.sid, request.args.get('symbol', ''))
   emit('leaderboard', get_leaders())
-  emit('orders', get_orders())
+  emit('orders', get_orders(current_user.id))
   return True
 
+@socketio.on('orders')
+def handle_orders(json):
+  """Send a page of order history after the given cursor."""
+  json = json or dict()
+  try:
+    emit('orders_page', get_order_page(current_user.id, json.get('cursor'), json.get('limit')))
+  except (ValueError, TypeError):
+    app.logger.warning("Malformed order history request: %s", json)
+
 @socketio.on('disconnect')
 def handle_disconnect():
   """Handle disconnect of websocket connection."""
   leave_room(current_user.username)
+  ticker.remove_client(request.sid)
 
 @socketio.on('chat')
 def handle_chat(json):
   """Handle incoming chat messages."""
   emit('chat', json, broadcast=True)
 
-@app.route('/trade', methods=['POST'])
-@login_required
-def trade():
-  """Client to broker endpoint."""
-  # Pass the trade request to broker
-  req = request.json
-  agent_name = req.pop('name', 'nobody')
-  resp = broker.handle(req)
-  if resp['retcode'] == 0 and req['action'] in (2, 3):
+def record_trade(req, resp, agent_name, user, balances):
+  """Record a successful broker response without committing.
+  In write-behind mode orders are queued as dictionaries instead.
+  :param user: user or ApiUser making the request
+  :param balances: collects new balances by user id to publish once committed
+  :return: new or closed order, None if nothing to record
+  """
+  if resp['retcode'] != 0:
+    return None
+  if req['action'] in (2, 3):
     # Record the new order
-    order = Order(id=resp['order_id'], user_id=current_user.id,
+    fields = dict(id=resp['order_id'], user_id=user.id,
                   type="BUY" if req['action'] == 2 else "SELL",
                   agent=agent_name, price_open=round(resp['price'], 5),
                   volume=req['volume'])
-    db.session.add(order)
-    db.session.commit()
-    # Send order update
-    socketio.emit('order', rows_to_dicts([order], ['id', 'agent', 'type', 'price_open', 'volume',
-                                                   'price_close', 'profit', 'closed', 'created'])[0],
-                  room=current_user.username)
-  elif resp['retcode'] == 0 and req['action'] == 1:
+    if writer.enabled:
+      order = dict(fields, price_close=None, profit=None, closed=None,
+                   created=datetime.datetime.now())
+      writer.add(order)
+    else:
+      order = Order(**fields)
+      db.session.add(order)
+    return order
+  if req['action'] == 1:
     # Close the recorded order
-    order = Order.query.get_or_404(req['order_id'])
-    order.price_close = round(resp['price'], 5)
-    order.profit = round(resp['profit'], 5)
-    order.closed = datetime.datetime.now()
-    current_user.balance = round(resp['profit'] + current_user.balance, 5)
+    changes = {'price_close': round(resp['price'], 5), 'profit': round(resp['profit'], 5),
+               'closed': datetime.datetime.now()}
+    if writer.enabled:
+      order = writer.get(req['order_id'])
+      balance = writer.balance(user.id)
+      if order is None or balance is None:
+        return None
+      balance = round(resp['profit'] + balance, 5)
+      order.update(changes)
+      writer.update(req['order_id'], changes)
+      writer.set_balance(user.id, balance)
+    else:
+      order = Order.query.get(req['order_id'])
+      row = User.query.get(user.id)
+      if order is None or row is None:
+        return None
+      for att, value in changes.items():
+        setattr(order, att, value)
+      row.balance = balance = round(resp['profit'] + row.balance, 5)
+    balances[user.id] = balance
+    return order
+  return None
+
+def commit_trades():
+  """Commit recorded trades unless they are written behind."""
+  if not writer.enabled:
+    start = metrics.start()
     db.session.commit()
-    # Send leaderboard update
-    socketio.emit('leaderboard', get_leaders())
+    metrics.stop('db_commit', start)
+
+def publish_trades(orders, balances, user):
+  """Update caches and clients once recorded trades are committed.
+  :param orders: recorded orders, None entries are skipped
+  :param balances: new balances by user id from record_trade
+  """
+  orders = rows_to_dicts([o for o in orders if o is not None], ORDER_FIELDS)
+  for order in orders:
+    if order['closed']:
+      pnl.remove(order['id'])
+    else:
+      pnl.add(order['id'], user.id, order['type'], order['price_open'], order['volume'])
+  for uid, balance in balances.items():
+    leaderboard.update(uid, user.username, balance)
+  if balances:
+    # Send a single leaderboard update
+    broadcast_leaders()
+  for order in orders:
     # Send order update
-    socketio.emit('order', rows_to_dicts([order], ['id', 'agent', 'type', 'price_open', 'volume',
-                                                   'price_close', 'profit', 'closed', 'created'])[0],
-                  room=current_user.username)
+    socketio.emit('order', order, room=user.username)
+
+@app.route('/trade', methods=['POST'])
+@login_required
+def trade():
+  """Client to broker endpoint, accepts a single or a list of requests."""
+  return handle_trade(request.json, current_user)
+
+@app.route('/api/trade', methods=['POST'])
+@tokens.required
+def api_trade(user):
+  """Token authenticated client to broker endpoint, same as /trade."""
+  return handle_trade(request.json, user)
+
+def handle_trade(req, user):
+  """Pass trade requests to the broker on behalf of user."""
+  start = metrics.start()
+  try:
+    return place_trade(req, user)
+  finally:
+    metrics.stop('trade', start)
+
+def place_trade(req, user):
+  """Execute and record a single or a list of trade requests."""
+  if isinstance(req, list):
+    return trade_batch(req, user)
+  # Pass the trade request to broker
+  agent_name = req.pop('name', 'nobody')
+  start = metrics.start()
+  resp = broker.handle(req)
+  metrics.stop('broker', start)
+  balances = dict()
+  order = record_trade(req, resp, agent_name, user, balances)
+  if order is None and req['action'] == 1:
+    abort(404)
+  commit_trades()
+  publish_trades([order], balances, user)
   return jsonify(resp)
 
+def trade_batch(reqs, user):
+  """Pass many trade requests to the broker in a single round trip."""
+  return jsonify(execute_batch(reqs, user))
+
+@channel.handler
+def channel_trade(token, agent_name, reqs):
+  """Trade requests arriving over the ZMQ channel."""
+  user = tokens.get(token)
+  if user is None:
+    abort(401)
+  for req in reqs:
+    req['name'] = agent_name
+  start = metrics.start()
+  try:
+    return execute_batch(reqs, user)
+  finally:
+    metrics.stop('trade', start)
+
+def execute_batch(reqs, user):
+  """Execute and record many trade requests.
+  :return: broker responses, failed ones have non-zero retcode
+  """
+  names = [r.pop('name', 'nobody') if isinstance(r, dict) else None for r in reqs]
+  start = metrics.start()
+  resps = broker.handle_many(reqs)
+  metrics.stop('broker', start)
+  balances = dict()
+  orders = list()
+  for req, resp, name in zip(reqs, resps, names):
+    order = record_trade(req, resp, name, user, balances)
+    if order is None and req['action'] == 1 and resp['retcode'] == 0:
+      resp['retcode'] = 404 # Unknown order, same as single requests
+    orders.append(order)
+  # Commit once for the whole batch
+  commit_trades()
+  publish_trades(orders, balances, user)
+  return resps
+
 def reset_account():
   """Reset current active account."""
   # Delete user orders
   Order.query.filter_by(user_id=current_user.id).delete()
+  pnl.remove_user(current_user.id)
   # Reset balance
   current_user.balance = 0
   db.session.commit()
+  leaderboard.update(current_user.id, current_user.username, current_user.balance)
   app.logger.info("Reset user: %s", current_user.username)
   # Send leaderboard update
-  socketio.emit('leaderboard', get_leaders())
+  broadcast_leaders()
   return redirect(url_for('index'))
 
 def delete_account():
@@ -144,9 +361,12 @@ def delete_account():
   logout_user()
   db.session.delete(user)
   db.session.commit()
+  tokens.revoke_user(user.id)
+  leaderboard.remove(user.id)
+  pnl.remove_user(user.id)
   app.logger.info("Delete user: %s", user.username)
   # Send leaderboard update
-  socketio.emit('leaderboard', get_leaders())
+  broadcast_leaders()
   return redirect(url_for('login'))
 
 def account_handler(action):
@@ -156,12 +376,17 @@ def account_handler(action):
     # Check username and password again
     if (form.username.data == current_user.username and
         current_user.is_correct_password(form.password.data)):
+      # Account actions work on the database directly
+      writer.flush()
       # Attempt to close any open orders first
       orders = Order.query.filter_by(user_id=current_user.id, closed=None).all()
-      for order in orders:
-        r = broker.talk(order_id=order.id, action=1)
-        if r['retcode'] != 0:
-          app.logger.error("Could not close %s order: %s", action, order.id)
+      size = app.config['BROKER_BATCH_SIZE']
+      for i in range(0, len(orders), size):
+        batch = orders[i:i+size]
+        resps = broker.talk_many([{'order_id': o.id, 'action': 1} for o in batch])
+        for order, r in zip(batch, resps):
+          if r['retcode'] != 0:
+            app.logger.error("Could not close %s order: %s", action, order.id)
       # Perform requests account action
       if action == "account_reset":
         return reset_account()
@@ -183,6 +408,18 @@ def account_delete():
   """Handler for account delete."""
   return account_handler("account_delete")
 
+@app.route('/stats')
+@login_required
+def stats():
+  """Ticker fan-out statistics."""
+  return jsonify(ticker=ticker.stats)
+
+@app.route('/metrics')
+@login_required
+def latency_metrics():
+  """Latency histograms in microseconds, empty unless METRICS is enabled."""
+  return jsonify(metrics.snapshot())
+
 @app.route('/logout')
 def logout():
   """Logout and redirect user."""
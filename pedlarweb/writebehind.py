@@ -0,0 +1,187 @@
+"""Write-behind persistence of orders for pedlarweb."""
+import atexit
+from contextlib import nullcontext
+import signal
+import sys
+import time
+
+from flask import has_app_context
+from eventlet import spawn_n, sleep
+from eventlet.semaphore import Semaphore
+
+from . import db
+from .models import User, Order
+
+
+class WriteBehind: # pylint: disable=too-many-instance-attributes
+  """Queue order inserts, closes and balances then flush them in batches.
+  Pending rows are kept in memory until committed by a background green
+  thread so that reads can merge them with the database.
+  """
+  def __init__(self, app, metrics=None):
+    self.app = app
+    self.metrics = metrics # Optional latency metrics of flushes
+    app.config.setdefault('ORDER_WRITE_BEHIND', False)
+    app.config.setdefault('ORDER_QUEUE_SIZE', 10000)
+    app.config.setdefault('ORDER_FLUSH_INTERVAL', 500)
+    app.config.setdefault('ORDER_FLUSH_BACKOFF', 30000)
+    self.enabled = app.config['ORDER_WRITE_BEHIND']
+    self._pending = self._empty() # Rows waiting for the next flush
+    self._flushing = self._empty() # Rows being flushed right now
+    self._lock = Semaphore() # Held by the flush in progress
+    self._backoff = 0.0 # Seconds waited after the last failed flush
+    self._retry_at = 0.0 # Monotonic time before which flushes are not retried
+    if self.enabled:
+      spawn_n(self.run)
+      atexit.register(self.close)
+      if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        # Exit normally on termination so pending rows are written
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+  @staticmethod
+  def _empty():
+    """New set of pending inserts, updates and balances."""
+    return {'inserts': dict(), 'updates': dict(), 'balances': dict()}
+
+  def __len__(self):
+    return sum(len(v) for v in self._pending.values())
+
+  def _lookup(self, kind, key):
+    """Find most recent pending value."""
+    for pending in (self._pending, self._flushing):
+      if key in pending[kind]:
+        return pending[kind][key]
+    return None
+
+  def _check_size(self):
+    """Flush in the calling green thread while the queue is full.
+    Blocks behind a flush in progress and waits out the back off of
+    failed flushes so the queue cannot grow without bound.
+    """
+    while len(self) >= self.app.config['ORDER_QUEUE_SIZE']:
+      sleep(max(self._retry_at - time.monotonic(), 0))
+      self.flush()
+
+  def add(self, order):
+    """Queue a new order row."""
+    self._pending['inserts'][order['id']] = order
+    self._check_size()
+
+  def update(self, order_id, fields):
+    """Queue changes to an order."""
+    order = self._pending['inserts'].get(order_id)
+    if order is not None:
+      # Not inserted yet, fold changes into the insert
+      order.update(fields)
+    else:
+      self._pending['updates'].setdefault(order_id, dict()).update(fields)
+    self._check_size()
+
+  def set_balance(self, user_id, balance):
+    """Queue new user balance."""
+    self._pending['balances'][user_id] = balance
+    self._check_size()
+
+  def balance(self, user_id):
+    """Return balance of a user including pending changes.
+    :return: balance or None if the user is not found
+    """
+    balance = self._lookup('balances', user_id)
+    if balance is None:
+      row = User.query.get(user_id)
+      balance = None if row is None else row.balance
+    return balance
+
+  def get(self, order_id):
+    """Return order as a dictionary including pending changes.
+    :return: order dictionary or None if not found
+    """
+    order = self._lookup('inserts', order_id)
+    if order is None:
+      row = Order.query.get(order_id)
+      if row is None:
+        return None
+      order = {c.name: getattr(row, c.name) for c in Order.__table__.columns}
+    else:
+      order = dict(order)
+    for pending in (self._flushing, self._pending):
+      order.update(pending['updates'].get(order_id, dict()))
+    return order
+
+  def merge(self, user_id, rows, limit, before=None):
+    """Merge pending orders into most recent order rows of a user.
+    :param rows: order dictionaries from the database
+    :param before: only orders older than this (created, id) key
+    :return: most recent order dictionaries
+    """
+    orders = {r['id']: r for r in rows}
+    for pending in (self._flushing, self._pending):
+      orders.update({oid: dict(o) for oid, o in pending['inserts'].items()
+                     if o['user_id'] == user_id and
+                     (before is None or (o['created'], oid) < before)})
+    for pending in (self._flushing, self._pending):
+      for oid, fields in pending['updates'].items():
+        if oid in orders:
+          orders[oid].update(fields)
+    return sorted(orders.values(), key=lambda o: (o['created'], o['id']), reverse=True)[:limit]
+
+  def flush(self):
+    """Commit all pending rows in a single transaction.
+    Waits for a flush in progress first, then flushes what is left.
+    :return: true if nothing is left pending
+    """
+    with self._lock:
+      if not len(self):
+        return True
+      return self._flush()
+
+  def _flush(self):
+    """Commit pending rows, restoring them if the commit fails."""
+    self._flushing, self._pending = self._pending, self._empty()
+    flushing = self._flushing
+    # Request green threads flush using their own context
+    start = self.metrics.start() if self.metrics else 0
+    with nullcontext() if has_app_context() else self.app.app_context():
+      try:
+        db.session.bulk_insert_mappings(Order, list(flushing['inserts'].values()))
+        db.session.bulk_update_mappings(Order, [dict(f, id=oid) for oid, f in
+                                                flushing['updates'].items()])
+        db.session.bulk_update_mappings(User, [{'id': uid, 'balance': b} for uid, b in
+                                               flushing['balances'].items()])
+        db.session.commit()
+        if start:
+          self.metrics.stop('db_flush', start)
+        self._backoff, self._retry_at = 0.0, 0.0
+        return True
+      except Exception: # pylint: disable=broad-except
+        db.session.rollback()
+        # Back off exponentially instead of retrying on every write
+        self._backoff = min(max(2*self._backoff, 2*self.app.config['ORDER_FLUSH_INTERVAL']/1000),
+                            self.app.config['ORDER_FLUSH_BACKOFF']/1000)
+        self._retry_at = time.monotonic() + self._backoff
+        self.app.logger.exception("Failed to flush orders, will retry in %s seconds.", self._backoff)
+        # Newer pending changes take precedence over the failed ones
+        for kind, rows in flushing.items():
+          rows.update(self._pending[kind])
+        self._pending = flushing
+        return False
+      finally:
+        self._flushing = self._empty()
+
+  def close(self):
+    """Write all pending rows on shutdown.
+    Failed flushes are retried until the back off reaches its maximum.
+    """
+    while not self.flush():
+      if self._backoff >= self.app.config['ORDER_FLUSH_BACKOFF']/1000:
+        self.app.logger.error("Giving up on %s pending order writes.", len(self))
+        return
+      sleep(max(self._retry_at - time.monotonic(), 0))
+
+  def run(self):
+    """Flush pending rows periodically."""
+    interval = self.app.config['ORDER_FLUSH_INTERVAL']/1000
+    while True:
+      sleep(interval)
+      if time.monotonic() >= self._retry_at:
+        self.flush()
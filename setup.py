@@ -24,7 +24,11 @@ setuptools.setup(
     "Topic :: Office/Business :: Financial",
   ],
   install_requires=[
+    'numpy',
     'pyzmq',
     'requests'
-  ]
+  ],
+  extras_require={
+    'async': ['aiohttp']
+  }
 )
@@ -0,0 +1,45 @@
+"""Backtest dispatch of the agent runtime."""
+import numpy as np
+
+from pedlar import backtest
+from pedlar.agent import Agent
+
+
+def make_data(kinds):
+  """Backtest data with a rising price for every row kind."""
+  n = len(kinds)
+  bids = 1.1 + np.arange(n)*1e-4
+  prices = np.c_[bids, bids + 2e-5, bids, bids]
+  return backtest.Data(kind=np.array(kinds, dtype=np.uint8),
+                       time=np.arange(n, dtype=np.int64)*10**9, prices=prices)
+
+
+class SymbolAgent(Agent):
+  """Agent following the per symbol hooks only."""
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.ticks = list()
+    self.bars = list()
+
+  def on_symbol_tick(self, symbol, bid, ask):
+    self.ticks.append((symbol, bid, ask))
+
+  def on_symbol_bar(self, symbol, bopen, bhigh, blow, bclose):
+    self.bars.append((symbol, bopen, bhigh, blow, bclose))
+
+
+def test_replay_calls_symbol_hooks():
+  data = make_data([backtest.TICK, backtest.BAR, backtest.TICK])
+  agent = SymbolAgent(backtest="test")
+  agent.local_run(data=data)
+  assert [t[0] for t in agent.ticks] == ["", ""]
+  assert agent.ticks[1][1:] == tuple(data.prices[2, :2])
+  assert agent.bars == [("",) + tuple(data.prices[1])]
+
+def test_replay_calls_tick_by_default():
+  data = make_data([backtest.TICK]*3)
+  ticks = list()
+  agent = Agent(backtest="test")
+  agent.on_tick = lambda bid, ask: ticks.append((bid, ask))
+  agent.local_run(data=data)
+  assert ticks == [tuple(r) for r in data.prices[:, :2].tolist()]